@@ -11,13 +11,16 @@ import os
 import importlib
 import json
 import base64
-import requests
-import yaml
-import pprint
+import io
 import logging
-import pathlib
+import re
+import signal
+import time
 
-from cmk.utils import password_store
+# Only modules needed by every run are imported here. requests, yaml, pprint,
+# concurrent.futures and cmk.utils.password_store are imported where they are
+# used, so runs that do not need them don't pay their import time. The DB driver
+# is imported with the selected backend module only.
 
 
 def _get_automation_secret(username="automation"):
@@ -34,13 +37,20 @@ def _get_automation_secret(username="automation"):
 
 class AgentDBLog:
     def __init__(self, logfile, loglevel):
-        """Initialize logging"""
+        """
+        Initialize logging. Every log file has its own logger, so the hosts processed
+        in one process (batch mode, collector daemon) keep their own file and level.
+        """
         self.loglevel = loglevel
-        self.log = logging.getLogger(__name__)
+        logname = os.path.splitext(os.path.basename(logfile))[0]
+        self.log = logging.getLogger(f"{__name__}.{logname}")
+        # Don't pass the records on to the logger of the module and its handlers
+        self.log.propagate = False
         if loglevel != "none":
             self.log.setLevel(self.loglevel.upper())
         else:
-            logging.disable()
+            # Disables this logger only, not the loggers of other hosts
+            self.log.setLevel(logging.CRITICAL + 1)
 
         # Create a custom formatter that includes the module name
         class FormatterWithClassName(logging.Formatter):
@@ -60,34 +70,36 @@ class AgentDBLog:
             file_handler.setFormatter(formatter)
             self.log.addHandler(file_handler)
 
-        # Pin the logger to the class
-        AgentDBLog.logger = self.log
+    def close(self):
+        """Close the log file, it is opened again by the next AgentDBLog of the file"""
+        for handler in list(self.log.handlers):
+            if isinstance(handler, logging.FileHandler):
+                self.log.removeHandler(handler)
+                handler.close()
 
-    @staticmethod
-    def log_error_and_exit(message):
-        """Static method to log an error and exit."""
-        if AgentDBLog.logger is not None:
-            print(message, file=sys.stderr)
-            AgentDBLog.logger.critical(message)
-            sys.exit(1)
-        else:
-            raise RuntimeError("Logger has not been initialized.")
+    def log_error_and_exit(self, message):
+        """Log an error and exit."""
+        print(message, file=sys.stderr)
+        self.log.critical(message)
+        sys.exit(1)
 
 
 class CMKInstance:
     """Interact with checkmk instance"""
 
-    def __init__(self, url=None, username="automation", password=None):
+    def __init__(self, url=None, username="automation", password=None, log=None):
         """Initialize a REST-API instance. URL, User and Secret can be automatically taken from local site if running as site user.
 
         Args:
             site_url: the site URL
             api_user: username of automation user account
             api_secret: automation secret
+            log: logger of the run, never write to stdout, it is the agent output
 
         Returns:
             instance of CMKRESTAPI
         """
+        self.log = log if log is not None else logging.getLogger(__name__)
         if not url:
             # site_url = _site_url()
             api_version = "1.0"
@@ -113,22 +125,29 @@ class CMKInstance:
             "Content-Type": "application/json",
         }
 
+        import requests
+
         self._session = requests.session()
         self._session.headers["Authorization"] = f"Bearer {username} {secret}"
         self._session.headers["Accept"] = "application/json"
 
     def _trans_resp(self, resp):
+        if resp.status_code == 304 or not resp.content:
+            # Not modified, there is no body to decode
+            return None, resp
         try:
             data = resp.json()
         except json.decoder.JSONDecodeError:
             data = resp.text
-            print(f"JSONDecodeError for data: {data}")
+            self.log.error(f"JSONDecodeError for data: {data}")
         return data, resp
 
-    def _request_url(self, method, endpoint, data={}, etag=None):
-        headers = self.headers
+    def _request_url(self, method, endpoint, data={}, etag=None, if_none_match=None):
+        headers = dict(self.headers)
         if etag is not None:
             headers["If-Match"] = etag
+        if if_none_match is not None:
+            headers["If-None-Match"] = if_none_match
 
         url = f"{self._api_url}/{endpoint}"
         request_func = getattr(self._session, method.lower())
@@ -167,6 +186,28 @@ class CMKInstance:
             return data
         resp.raise_for_status()
 
+    def get_host_if_modified(self, hostname, etag=None):
+        """Get current host configuration, if it differs from the etag
+
+        Args:
+            hostname: cmk hostname
+            etag: etag of the host configuration known to the caller
+
+        Return:
+            (data, etag): data is None if the host configuration is unchanged
+        """
+        data, resp = self._request_url(
+            "GET",
+            f"objects/host_config/{hostname}",
+            data={"effective_attributes": "false"},
+            if_none_match=etag,
+        )
+        if resp.status_code == 304:
+            return None, etag
+        if resp.status_code == 200:
+            return data, resp.headers.get("etag")
+        resp.raise_for_status()
+
     def get_host_attributes(self, hostname):
         return self.get_host(hostname)["extensions"]["attributes"]
 
@@ -196,7 +237,52 @@ def deserialize_agent_db_arguments(base64_params):
     return json.loads(json_params)
 
 
-def resolve_custom_host_attr(param, value, hostname):
+def get_cached_host_attributes(hostname, cache_dir, max_cache_age_sec, log=None):
+    """
+    Get the attributes of a host from the REST API. The attributes are cached in
+    cache_dir and shared by all agent_db processes. A cache entry older than
+    max_cache_age_sec is revalidated with its ETag, so an unchanged host
+    configuration is not transferred again.
+
+    Args:
+    hostname (str): The Checkmk hostname.
+    cache_dir (str): Directory of the host configuration cache.
+    max_cache_age_sec (int): Seconds a cache entry is used without revalidation.
+    log (logging.Logger): Logger of the run (optional).
+
+    Returns:
+    dict: The (not effective) attributes of the host.
+    """
+    cache_file = os.path.join(cache_dir, f"{hostname}.json")
+    cached = None
+    try:
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+        if time.time() - os.path.getmtime(cache_file) < max_cache_age_sec:
+            return cached["attributes"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    cmkinst = CMKInstance(log=log)
+    etag = cached.get("etag") if cached else None
+    data, etag = cmkinst.get_host_if_modified(hostname, etag)
+    if data is None:
+        # Not modified, the cache entry is valid for another max_cache_age_sec
+        os.utime(cache_file)
+        return cached["attributes"]
+
+    attributes = data["extensions"]["attributes"]
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first, so concurrent agents never read a partial file
+    tmp_file = f"{cache_file}.{os.getpid()}"
+    with open(tmp_file, "w") as f:
+        json.dump({"etag": etag, "attributes": attributes}, f)
+    os.replace(tmp_file, cache_file)
+    return attributes
+
+
+def resolve_custom_host_attr(param, value, hostname, get_host_attributes=None):
     """
     Resolves a custom host attribute from a parameter specification.
 
@@ -204,6 +290,8 @@ def resolve_custom_host_attr(param, value, hostname):
     param (str): The parameter name to check.
     value: The value associated with the parameter which might be a list or string.
     hostname (str): The hostname used to fetch the custom attribute.
+    get_host_attributes (callable): Returns the attributes of a hostname.
+        If not given, the attribute is requested from the REST API.
 
     Returns:
     str or None: The resolved custom host attribute value or None if not applicable.
@@ -213,6 +301,8 @@ def resolve_custom_host_attr(param, value, hostname):
 
     if isinstance(value, str) and value.startswith("<<") and value.endswith(">>"):
         custom_host_attr = value.strip("<<>>")
+        if get_host_attributes is not None:
+            return get_host_attributes(hostname).get(custom_host_attr, None)
         cmkinst = CMKInstance()
         custom_host_attr_value = cmkinst.get_custom_host_attr(
             hostname, custom_host_attr
@@ -225,7 +315,17 @@ def resolve_custom_host_attr(param, value, hostname):
 
 
 class DBHandler:
-    def __init__(self, ipaddress, args, params, log, statement_config, backend_module):
+    def __init__(
+        self,
+        ipaddress,
+        args,
+        params,
+        log,
+        statement_config,
+        backend_module,
+        output=None,
+        strategy_cache=None,
+    ):
 
         self.ipaddress = ipaddress
         self.args = args
@@ -233,18 +333,44 @@ class DBHandler:
         self.log = log
         self.statement_config = statement_config
         self.backend_module = backend_module
+        # writer.AgentOutput of the run, see run_agent
+        self.output = output
+        # Strategies with open connections kept across runs by the collector daemon,
+        # keyed by (hostname, backend, cstr). None closes connections after each run.
+        self.strategy_cache = strategy_cache
+        # All statements of the run have to be done by then, None without deadline
+        run_deadline_sec = self._get_run_deadline_sec()
+        self.run_deadline = time.time() + run_deadline_sec if run_deadline_sec else None
         # Get the backend and backend parameters
         # e.g. ("cmk_oracle", {'port': 1521, 'default_pkgs': ['basic', 'standard', 'performance']})
         self.backend, self.backend_params = self.params["db_backend"]
+        # Host attributes from the REST API, fetched once per run
+        self.host_attributes = None
+        # PortChecker of every probed (host, port), see _probe_ports
+        self.port_probes = {}
+
+    def _get_host_attributes(self, hostname):
+        if self.host_attributes is None:
+            self.host_attributes = get_cached_host_attributes(
+                hostname,
+                f"{os.environ['OMD_ROOT']}/var/tmp/agent_db/host_config",
+                self.statement_config.get("custom_host_attr_cache_sec", 300),
+                log=self.log.log,
+            )
+        return self.host_attributes
 
     def resolve_custom_host_attrs(self, hostname):
         for param, value in self.params.items():
-            resolved_custom_host_attr = resolve_custom_host_attr(param, value, hostname)
+            resolved_custom_host_attr = resolve_custom_host_attr(
+                param, value, hostname, self._get_host_attributes
+            )
             if resolved_custom_host_attr:
                 self.params[param] = resolved_custom_host_attr
 
         for key, val in self.backend_params.items():
-            resolved_custom_host_attr = resolve_custom_host_attr(key, val, hostname)
+            resolved_custom_host_attr = resolve_custom_host_attr(
+                key, val, hostname, self._get_host_attributes
+            )
             if resolved_custom_host_attr:
                 self.backend_params[key] = resolved_custom_host_attr
 
@@ -259,7 +385,7 @@ class DBHandler:
             elif self.backend == "cmk_postgres":
                 db_cstr = "postgres"
             else:
-                AgentDBLog.log_error_and_exit(
+                self.log.log_error_and_exit(
                     "No DB connect string provided. Please define either via Checkmk ruleset or custom host attribute."
                 )
 
@@ -295,23 +421,41 @@ class DBHandler:
 
         # Special handling for oracle_asm_diskgroup statement, because it needs to be executed only once with a special connection object
         try:
-            statement_desc = self.statement_config[self.backend]["statement_desc"]
+            self.backend_statement_cfg = self.statement_config[self.backend]
+            statement_desc = self.backend_statement_cfg["statement_desc"]
         except KeyError:
-            AgentDBLog.log_error_and_exit(
+            self.log.log_error_and_exit(
                 f"No statement_desc found in agent.yml for backend {self.backend}",
             )
+        # Same for all hosts of the process, the statement config is site-wide
+        self.backend_module.DBStrategy.statement_timeout_sec = (
+            self._get_longest_statement_timeout()
+        )
 
         if "oracle_asm_diskgroup" in statement_desc:
-            # Execute self._process_single_connection for all connection strings without "oracle_asm_diskgroup"
-            asm_diskgroup_value = statement_desc.pop("oracle_asm_diskgroup")
+            # Execute self._process_single_connection for all connection strings without "oracle_asm_diskgroup".
+            # The statement config is shared between runs (batch mode, collector daemon)
+            # and must not be modified, so derived copies are used.
+            backend_statement_cfg = self.backend_statement_cfg
+            self.backend_statement_cfg = dict(
+                backend_statement_cfg,
+                statement_desc={
+                    name: cfg
+                    for name, cfg in statement_desc.items()
+                    if name != "oracle_asm_diskgroup"
+                },
+            )
 
             db_cstr_list = self.determine_db_connection_string()
-            for cstr in db_cstr_list:
-                self._process_single_connection(cstr)
-
-            # Modify statement_desc to only contain "oracle_asm_diskgroup"
-            statement_desc.clear()
-            statement_desc["oracle_asm_diskgroup"] = asm_diskgroup_value
+            self._process_connections(db_cstr_list)
+
+            # Use a statement_desc that only contains "oracle_asm_diskgroup"
+            self.backend_statement_cfg = dict(
+                backend_statement_cfg,
+                statement_desc={
+                    "oracle_asm_diskgroup": statement_desc["oracle_asm_diskgroup"]
+                },
+            )
 
             # Execute self._process_single_connection with the first connection string for "oracle_asm_diskgroup"
             # Since it doesen't matter which connection string is used for "oracle_asm_diskgroup", because ASM+ is used we do it currently that way.
@@ -319,60 +463,365 @@ class DBHandler:
             # Then def _select_connection(self, state_statement_cfg, params): in cmk_oracle.py would be obsolete.
 
             if db_cstr_list:
-                self._process_single_connection(db_cstr_list[0])
+                self._process_single_connection(db_cstr_list[0], self.output)
 
         else:
             db_cstr_list = self.determine_db_connection_string()
             if self.backend_params.get("monitor_all"):
+                from cmk.special_agents.db import cache
+
                 # Default cstr is the first in the list and will be used for the initial connection
                 # e.g. mssql: db_cstr = 'master'
+                self._probe_ports(db_cstr_list[:1])
                 db_backend_params = self._get_backend_params(db_cstr_list[0])
-                strategy = self.backend_module.DBStrategy(**db_backend_params)
+                # From the strategy cache of the collector daemon, so the connection
+                # listing the databases is not opened again on every run
+                strategy = self._get_strategy(db_backend_params, self.output)
+                if strategy is None:
+                    # The connection error has been logged and written by _get_strategy
+                    self.log.log_error_and_exit(
+                        f"Could not connect to DB {db_cstr_list[0]} to get list of DBs"
+                    )
 
+                all_dbs_cache_key = cache.generate_cache_key(
+                    self.ipaddress, db_cstr_list[0], "monitor_all_dbs"
+                )
                 if isinstance(strategy.connection, strategy.FormattedErrorMessage):
-                    # If connection object is from type FormattedErrorMessage, log error and exit special agent directly
-                    AgentDBLog.log_error_and_exit(
-                        f"Could not connect to DB {db_cstr_list[0]} to get list of DBs - {strategy.connection}"
-                    )
-                all_dbs = strategy.list_all_dbs()
-                strategy.close_db_connection()
+                    all_dbs = None
+                    if strategy.circuit_open:
+                        # The databases known from the last run serve their cached results
+                        cached = cache.get_cache(all_dbs_cache_key, strategy.cache_dir, None)
+                        all_dbs = cached[1] if cached is not None else None
+                    strategy.release_session_slots()
+                    if all_dbs is None:
+                        # If connection object is from type FormattedErrorMessage, log error and exit special agent directly
+                        self.log.log_error_and_exit(
+                            f"Could not connect to DB {db_cstr_list[0]} to get list of DBs - {strategy.connection}"
+                        )
+                else:
+                    try:
+                        all_dbs = strategy.list_all_dbs()
+                    except Exception:
+                        strategy.close_db_connection()
+                        raise
+                    strategy._write_cache(all_dbs_cache_key, all_dbs)
+                    self._release_strategy(db_cstr_list[0], strategy)
                 exclude_dbs = self.backend_params["monitor_all"].get("exclude_dbs", [])
                 db_cstr_list = [db for db in all_dbs if db not in exclude_dbs]
-            for cstr in db_cstr_list:
-                self._process_single_connection(cstr)
+            self._process_connections(db_cstr_list)
+
+    def _get_longest_statement_timeout(self):
+        """Longest timeout_sec of the statements of the backend"""
+        default_timeout = self.backend_statement_cfg.get("default_timeout_sec", 15)
+        return max(
+            [default_timeout]
+            + [
+                (cfg or {}).get("timeout_sec", default_timeout)
+                for cfg in self.backend_statement_cfg["statement_desc"].values()
+            ]
+        )
 
-    def _process_single_connection(self, cstr):
-        db_backend_params = self._get_backend_params(cstr)
+    def _get_parallel_connections(self):
+        """
+        Maximum number of connection strings processed at the same time.
+        The ruleset value takes precedence over the agent_db.yml setting.
+        """
+        parallel_connections = self.params.get(
+            "parallel_connections",
+            self.statement_config.get("parallel_connections", 1),
+        )
+        return max(1, int(parallel_connections))
+
+    def _get_run_deadline_sec(self):
+        """
+        Seconds after the start of the run by which all statements have to be done,
+        None without deadline. The ruleset value takes precedence over the
+        agent_db.yml setting.
+        """
+        return self.params.get(
+            "run_deadline_sec", self.statement_config.get("run_deadline_sec")
+        )
+
+    def _process_connections(self, db_cstr_list):
+        """
+        Process all connection strings, either one after another or with a bounded
+        worker pool. In the latter case every worker writes into its own buffer and the
+        buffers are merged into the output in the order of db_cstr_list, so the agent
+        output does not depend on the order in which the workers finish.
+        The output is flushed after every connection.
+
+        If the agent is terminated, the sections completed so far are kept and the
+        statements of the connections not processed are added to agent_db_stats
+        as skipped before basedb.AgentTerminated is raised.
+        """
+        from cmk.special_agents.db import basedb
+
+        self._probe_ports(db_cstr_list)
+        max_workers = min(self._get_parallel_connections(), len(db_cstr_list))
+        if max_workers <= 1:
+            for index, cstr in enumerate(db_cstr_list):
+                try:
+                    self._process_single_connection(cstr, self.output)
+                except basedb.AgentTerminated as e:
+                    self._add_skipped_connections(db_cstr_list[index:], str(e))
+                    raise
+                self.output.flush()
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
 
-        self.log.log.debug(f"Call {self.backend} DBStrategy with following parameters:")
         self.log.log.debug(
-            pprint.pformat(db_backend_params).replace(
-                db_backend_params["db_pass"], "*****"
-            )
+            f"Processing {len(db_cstr_list)} connections with {max_workers} workers"
         )
+        terminated = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self._process_buffered_connection, cstr)
+                for cstr in db_cstr_list
+            ]
+            for cstr, future in zip(db_cstr_list, futures):
+                output, error = future.result()
+                self.output.merge(output)
+                if error is not None:
+                    terminated = error
+                    self._add_skipped_connections([cstr], str(error))
+                self.output.flush()
+        if terminated is not None:
+            raise terminated
+
+    def _process_buffered_connection(self, cstr):
+        """
+        Returns:
+            tuple: The buffer of the connection and the basedb.AgentTerminated
+            exception if the agent has been terminated meanwhile, else None.
+        """
+        from cmk.special_agents.db import basedb
+
+        output = self.output.child()
+        try:
+            self._process_single_connection(cstr, output)
+        except basedb.AgentTerminated as e:
+            # The sections completed before are still merged into the output
+            return output, e
+        return output, None
+
+    def _add_skipped_connections(self, db_cstr_list, reason):
+        """Add the planned statements of the connection strings as skipped to agent_db_stats"""
+        from cmk.special_agents.db import plan
+
+        for cstr in db_cstr_list:
+            statement_plan = plan.get_statement_plan(
+                self.backend_statement_cfg["statement_desc"],
+                self.backend_params,
+                cstr,
+                self.args.hostname,
+            )
+            self.output.add_skipped_statements(
+                cstr, [name for name, _cfg in statement_plan], reason
+            )
+
+    def _process_single_connection(self, cstr, output=None):
+        from cmk.special_agents.db import basedb
+
+        # No new connections once the agent is terminated
+        basedb.check_termination()
+        db_backend_params = self._get_backend_params(cstr)
 
-        strategy = self.backend_module.DBStrategy(**db_backend_params)
+        if self.log.log.isEnabledFor(logging.DEBUG):
+            import pprint
+
+            self.log.log.debug(
+                f"Call {self.backend} DBStrategy with following parameters:"
+            )
+            self.log.log.debug(
+                pprint.pformat(db_backend_params).replace(
+                    db_backend_params["db_pass"], "*****"
+                )
+            )
+
+        strategy = self._get_strategy(db_backend_params, output)
+        if strategy is None:
+            return
+        strategy.run_deadline = self.run_deadline
         # Execute statements only if connection object is available
         result = strategy._select_connection({}, self.params)
 
         if result is not None and not isinstance(
             result, strategy.FormattedErrorMessage
         ):
-            strategy.exec_statements(
-                self.statement_config[self.backend], self.backend_params, self.params
+            try:
+                strategy.exec_statements(
+                    self.backend_statement_cfg,
+                    self.backend_params,
+                    self.params,
+                )
+            except basedb.AgentTerminated:
+                # A cancelled query may still be running on the connection, closing
+                # it under the query is left to the end of the process
+                strategy.release_session_slots()
+                raise
+            except Exception:
+                strategy.close_db_connection()
+                raise
+            self._release_strategy(cstr, strategy)
+        else:
+            if strategy.circuit_open:
+                # The database is known to be down, serve what is cached meanwhile
+                strategy.exec_cached_statements(
+                    self.backend_statement_cfg, self.backend_params
+                )
+            strategy.release_session_slots()
+
+    def _strategy_cache_key(self, cstr):
+        return (self.args.hostname, self.backend, cstr)
+
+    def _get_strategy(self, db_backend_params, output):
+        """
+        Return a strategy with a warm connection from the strategy cache if there is
+        a usable one, otherwise create (and connect) a new strategy.
+        """
+        if self.strategy_cache is not None:
+            key = self._strategy_cache_key(db_backend_params["db_cstr"])
+            # Taken out of the cache while in use, so it is never shared between runs
+            strategy = self.strategy_cache.pop(key, None)
+            if strategy is not None:
+                if strategy.reuse_connection(output):
+                    self.log.log.debug(f"Reusing connection for {key}")
+                    return strategy
+                self.log.log.debug(f"Connection for {key} not usable anymore")
+                try:
+                    strategy.close_db_connection()
+                except Exception:
+                    pass
+
+        if self._check_port_probe(db_backend_params["db_cstr"], output):
+            # The driver would only wait for its connect timeout
+            return None
+        probe = self.port_probes.get(
+            self._get_probe_target(db_backend_params["db_cstr"])
+        )
+
+        limiter = self._get_session_limiter(db_backend_params)
+        slot = None
+        if limiter is not None:
+            wait_sec = self.statement_config["session_limit"].get("wait_sec", 30)
+            slot = limiter.acquire(wait_sec)
+            if slot is None:
+                error = (
+                    f"Session limit of {limiter.max_sessions} for "
+                    f"{limiter.db_host}:{limiter.db_port} reached, waited {wait_sec}s"
+                )
+                self.log.log.error(error)
+                self._print_connection_error(db_backend_params["db_cstr"], error, output)
+                return None
+        try:
+            strategy = self.backend_module.DBStrategy(
+                **db_backend_params,
+                output=output,
+                probe_time=probe.probe_time if probe is not None else None,
             )
+        except BaseException:
+            if slot is not None:
+                slot.release()
+            raise
+        if slot is not None:
+            strategy.session_limiter = limiter
+            strategy.session_slots.append(slot)
+        return strategy
+
+    def _get_session_limiter(self, db_backend_params):
+        return get_session_limiter(self.statement_config, db_backend_params)
+
+    def _get_probe_target(self, cstr):
+        """(host, port) the driver connects to for the connection string"""
+        if cstr.startswith("("):
+            # Oracle connect descriptor, e.g. (DESCRIPTION=(ADDRESS=(PROTOCOL=TCP)(HOST=db1)(PORT=1521))...)
+            host = re.search(r"\(\s*HOST\s*=\s*([^)\s]+)", cstr, re.IGNORECASE)
+            port = re.search(r"\(\s*PORT\s*=\s*(\d+)", cstr, re.IGNORECASE)
+            if host and port:
+                return (host.group(1), int(port.group(1)))
+        return (self.ipaddress, int(self.backend_params["port"]))
+
+    def _probe_ports(self, db_cstr_list):
+        """
+        Probe the ports of all connection strings concurrently if port_preflight is
+        enabled, so unreachable databases fail without waiting for the driver's
+        connect timeout. The probes are kept in self.port_probes.
+        """
+        if not self.statement_config.get("port_preflight", False):
+            return
+        from cmk.special_agents.db import basedb
+
+        timeout = self.statement_config.get("db_cursor_timeout_sec", 3)
+        targets = {self._get_probe_target(cstr) for cstr in db_cstr_list}
+        checkers = [
+            basedb.PortChecker(host, port, timeout)
+            for host, port in sorted(targets - set(self.port_probes))
+        ]
+        basedb.probe_ports(checkers)
+        for checker in checkers:
+            self.log.log.debug(
+                f"Probed {checker.host}:{checker.port} in {checker.probe_time:.3f}s: "
+                f"{checker.error or 'open'}"
+            )
+            self.port_probes[(checker.host, checker.port)] = checker
+
+    def _check_port_probe(self, cstr, output):
+        """
+        Write the connection error of a connection string whose pre-flight probe failed.
+
+        Returns:
+            str: The error or None if the port is reachable or has not been probed.
+        """
+        probe = self.port_probes.get(self._get_probe_target(cstr))
+        if probe is None or probe.error is None:
+            return None
+        error = (
+            f"Port {probe.port}/TCP of {probe.host} not reachable from checkmk server "
+            f"({probe.error}), DB '{cstr}' not connected"
+        )
+        self.log.log.error(error)
+        self._print_connection_error(cstr, error, output, probe.probe_time)
+        return error
+
+    def _print_connection_error(self, cstr, error, output, probe_time=None):
+        """Add the <backend>_connection_time entry of a connection that was not attempted"""
+        output = output if output is not None else self.output
+        # e.g. cmk_oracle -> oracle_connection_time
+        output.add_connection_time(self.backend[len("cmk_") :], cstr, 0, error, probe_time)
+
+    def _release_strategy(self, cstr, strategy):
+        if self.strategy_cache is not None:
+            self.strategy_cache[self._strategy_cache_key(cstr)] = strategy
+        else:
             strategy.close_db_connection()
 
 
+def get_session_limiter(statement_config, db_backend_params):
+    """Site-wide limiter of the sessions per database server, None if not configured"""
+    max_sessions = statement_config.get("session_limit", {}).get("max_sessions")
+    if not max_sessions:
+        return None
+    from cmk.special_agents.db import limiter
+
+    return limiter.SessionLimiter(
+        f"{os.environ['OMD_ROOT']}/var/tmp/agent_db/sessions",
+        db_backend_params["db_host"],
+        db_backend_params["db_port"],
+        max_sessions,
+    )
+
+
 def lookup_password_arg(pw_arg):
-    pw_id, pw_file = pw_arg.split(":", maxsplit=1)
-    return password_store.lookup(pathlib.Path(pw_file), pw_id)
+    import pathlib
 
+    from cmk.utils import password_store
 
-def main():
-    """Main function"""
+    pw_id, pw_file = pw_arg.split(":", maxsplit=1)
+    return password_store.lookup(pathlib.Path(pw_file), pw_id)
 
 
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(description="Checkmk DB Special Agent")
     parser.add_argument(
         "--backend",
@@ -406,8 +855,62 @@ def main():
         required=False,
         help="ASM Password",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--no-collector",
+        action="store_true",
+        help="Do not ask a running agent_db collector daemon, always query the databases directly",
+    )
+    parser.add_argument(
+        "--collector-timeout",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for the agent_db collector daemon before querying the databases directly",
+    )
+    return parser.parse_args(argv)
+
+
+def load_statement_config(omd_root, log):
+    """Load the statement configuration from agent_db.yml"""
+    configfile = get_config_file(omd_root)
+    log.log.info(f"Loading config from: {configfile}")
 
+    if os.path.exists(configfile):
+        from cmk.special_agents.db import plan
+
+        # Parsed only once per change of the config file, see plan.load_config
+        return plan.load_config(configfile, f"{omd_root}/var/tmp/agent_db")
+    log.log_error_and_exit(f"Config file {configfile} not found.")
+
+
+def get_collector_socket_path(omd_root):
+    return f"{omd_root}/tmp/run/agent_db_collector.sock"
+
+
+def get_config_file(omd_root):
+    # Determine which config file to use (priority order):
+    # 1. ~/etc/agent_db.yml (backwards compatibility)
+    # 2. ~/local/etc/agent_db.yml (custom config)
+    # 3. ~/local/etc/agent_db_default.yml (default config)
+    for configfile in [
+        f"{omd_root}/etc/agent_db.yml",
+        f"{omd_root}/local/etc/agent_db.yml",
+    ]:
+        if os.path.exists(configfile):
+            return configfile
+    return f"{omd_root}/local/etc/agent_db_default.yml"
+
+
+def run_agent(args, statement_config=None, output=None, strategy_cache=None):
+    """
+    Query the databases of one host and write the agent sections to output.
+
+    Args:
+        args: Parsed command line arguments, see parse_arguments.
+        statement_config: Content of agent_db.yml, loaded from disk if not given.
+        output: Stream the sections are written to, defaults to stdout. The output is
+            buffered and written at the end of every connection and of the run.
+        strategy_cache: Strategies with open connections kept across runs (collector daemon).
+    """
     OMD_ROOT = os.environ["OMD_ROOT"]
 
     if args.base64args:
@@ -437,33 +940,416 @@ def main():
 
     log = AgentDBLog(f"{logpath}/{hostname}.log", loglevel)
 
-    # Determine which config file to use (priority order):
-    # 1. ~/etc/agent_db.yml (backwards compatibility)
-    # 2. ~/local/etc/agent_db.yml (custom config)
-    # 3. ~/local/etc/agent_db_default.yml (default config)
-    configfile = f"{OMD_ROOT}/etc/agent_db.yml"
-    if os.path.exists(configfile):
-        log.log.info(f"Loading config from backwards compatibility path: {configfile}")
-    elif os.path.exists(f"{OMD_ROOT}/local/etc/agent_db.yml"):
-        configfile = f"{OMD_ROOT}/local/etc/agent_db.yml"
-        log.log.info(f"Loading config from: {configfile}")
-    else:
-        configfile = f"{OMD_ROOT}/local/etc/agent_db_default.yml"
-        log.log.info(f"Loading default config from: {configfile}")
+    if statement_config is None:
+        statement_config = load_statement_config(OMD_ROOT, log)
 
-    if os.path.exists(configfile):
-        with open(configfile, "r") as f:
-            statement_config = yaml.safe_load(f)
-    else:
-        AgentDBLog.log_error_and_exit(f"Config file {configfile} not found.")
+    from cmk.special_agents.db import breaker
+    from cmk.special_agents.db import cache
+    from cmk.special_agents.db import writer
+
+    breaker.configure(statement_config.get("circuit_breaker"))
+    cache.configure(statement_config.get("cache"))
 
     backend_module = importlib.import_module(
         f"cmk.special_agents.db.{params['db_backend'][0]}"
     )
+    agent_output = writer.AgentOutput(output if output is not None else sys.stdout)
+
+    handler = DBHandler(
+        ippaddress,
+        args,
+        params,
+        log,
+        statement_config,
+        backend_module,
+        output=agent_output,
+        strategy_cache=strategy_cache,
+    )
+    try:
+        handler.resolve_custom_host_attrs(hostname)
+        handler.process_db_connections()
+    finally:
+        # Also on errors, e.g. log_error_and_exit, the sections written so far and
+        # the agent_db_stats and connection time entries are not lost
+        agent_output.close()
+        if strategy_cache is None:
+            # Batch mode runs many hosts in one process, don't keep all log files
+            # open. The collector daemon keeps them for the strategies it caches.
+            log.close()
+
+
+def parse_batch_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Checkmk DB Special Agent - batch mode for many hosts"
+    )
+    parser.add_argument(
+        "--batch",
+        required=True,
+        metavar="MANIFEST",
+        help="JSON file with a list of hosts, each with the keys hostname, ipaddress, "
+        "base64args, password and optionally asm_password",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of hosts processed at the same time",
+    )
+    parser.add_argument(
+        "--output-mode",
+        choices=["piggyback", "spool"],
+        default="piggyback",
+        help="Write the host outputs as piggyback data to stdout or to spool files, "
+        "which the agent_db runs of the hosts serve instead of querying the databases",
+    )
+    parser.add_argument(
+        "--spool-max-age",
+        type=int,
+        default=120,
+        help="Seconds the agent_db runs of the hosts serve a spool file",
+    )
+    parser.add_argument(
+        "--loglevel",
+        choices=["debug", "info", "warning", "error"],
+        default="error",
+        help="Loglevel of the batch log",
+    )
+    return parser.parse_args(argv)
+
+
+def _batch_host_argv(host):
+    argv = [
+        "--base64args",
+        host["base64args"],
+        "--hostname",
+        host["hostname"],
+        "--ipaddress",
+        host["ipaddress"],
+        "--password",
+        host["password"],
+    ]
+    if host.get("asm_password"):
+        argv += ["--asm_password", host["asm_password"]]
+    return argv
+
+
+def _run_batch_host(host, statement_config, log):
+    """
+    Run agent_db for one host of a batch manifest.
+
+    Returns:
+        tuple: The output of the host and True if the run succeeded.
+    """
+    output = io.StringIO()
+    try:
+        args = parse_arguments(_batch_host_argv(host))
+        run_agent(args, statement_config=statement_config, output=output)
+        return output.getvalue(), True
+    except SystemExit as e:
+        log.log.error(f"agent_db run for host {host.get('hostname')} failed: {e}")
+    except Exception as e:
+        log.log.exception(f"agent_db run for host {host.get('hostname')} failed: {e}")
+    return output.getvalue(), False
+
+
+def get_spool_dir(omd_root):
+    return f"{omd_root}/var/tmp/agent_db/spool"
+
+
+def read_spool(omd_root, hostname):
+    """
+    Read the output of the host written by agent_db --batch --output-mode spool.
+
+    Returns:
+        str or None: The output of the host, None if there is no spool file or it expired.
+    """
+    try:
+        with open(os.path.join(get_spool_dir(omd_root), hostname), "r") as f:
+            spool = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if spool.get("expires", 0) < time.time():
+        return None
+    return spool.get("output")
+
+
+def run_batch(batch_args):
+    """
+    Process all hosts of a batch manifest concurrently in this process, so the
+    interpreter startup, imports and config loading are paid only once.
+    """
+    OMD_ROOT = os.environ["OMD_ROOT"]
+
+    logpath = f"{OMD_ROOT}/var/log/agent_db"
+    if not os.path.exists(logpath):
+        os.makedirs(logpath)
+    log = AgentDBLog(f"{logpath}/batch.log", batch_args.loglevel)
+
+    with open(batch_args.batch, "r") as f:
+        hosts = json.load(f)
+    statement_config = load_statement_config(OMD_ROOT, log)
 
-    handler = DBHandler(ippaddress, args, params, log, statement_config, backend_module)
-    handler.resolve_custom_host_attrs(hostname)
-    handler.process_db_connections()
+    from concurrent.futures import ThreadPoolExecutor
+
+    def process_host(host):
+        return _run_batch_host(host, statement_config, log)[0]
+
+    spool_dir = get_spool_dir(OMD_ROOT)
+    if batch_args.output_mode == "spool" and not os.path.exists(spool_dir):
+        os.makedirs(spool_dir)
+
+    with ThreadPoolExecutor(max_workers=max(1, batch_args.workers)) as executor:
+        futures = [executor.submit(process_host, host) for host in hosts]
+        for host, future in zip(hosts, futures):
+            host_output = future.result()
+            if batch_args.output_mode == "piggyback":
+                sys.stdout.write(f"<<<<{host['hostname']}>>>>\n")
+                sys.stdout.write(host_output)
+                sys.stdout.write("<<<<>>>>\n")
+            else:
+                # Write to a temporary file first, so readers never see partial output
+                spool_file = os.path.join(spool_dir, host["hostname"])
+                with open(f"{spool_file}.new", "w") as f:
+                    json.dump(
+                        {
+                            "expires": time.time() + batch_args.spool_max_age,
+                            "output": host_output,
+                        },
+                        f,
+                    )
+                os.replace(f"{spool_file}.new", spool_file)
+
+
+def parse_cache_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog="agent_db cache",
+        description="Checkmk DB Special Agent - manage the statement result cache",
+    )
+    parser.add_argument(
+        "action",
+        choices=["warm", "inspect", "purge", "size"],
+        help="warm: run agent_db for the hosts to fill the cache, inspect: list the "
+        "cache entries, purge: remove the cache entries, size: show the cache size "
+        "and hit/miss counters",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="MANIFEST",
+        help="JSON file with a list of hosts, see agent_db --batch. Required for warm",
+    )
+    parser.add_argument(
+        "--host",
+        action="append",
+        default=[],
+        help="Address of a host as used by agent_db (IP address, or hostname with "
+        "enforce DNS lookup). Can be given multiple times",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of hosts warmed at the same time",
+    )
+    parser.add_argument(
+        "--loglevel",
+        choices=["debug", "info", "warning", "error"],
+        default="error",
+        help="Loglevel of the cache log",
+    )
+    return parser.parse_args(argv)
+
+
+def run_cache_command(cache_args):
+    """
+    Warm, inspect, purge or measure the statement result cache, e.g. off-peak for
+    the hosts of a batch manifest. Without hosts, inspect and purge apply to all
+    cache entries.
+    """
+    OMD_ROOT = os.environ["OMD_ROOT"]
+
+    logpath = f"{OMD_ROOT}/var/log/agent_db"
+    if not os.path.exists(logpath):
+        os.makedirs(logpath)
+    log = AgentDBLog(f"{logpath}/cache.log", cache_args.loglevel)
+    statement_config = load_statement_config(OMD_ROOT, log)
+
+    from cmk.special_agents.db import cache
+
+    cache.configure(statement_config.get("cache"))
+    cache_dir = f"{OMD_ROOT}/var/tmp/agent_db/cache"
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    cache_backend = cache.get_cache_backend(cache_dir)
+
+    hosts = []
+    if cache_args.batch:
+        with open(cache_args.batch, "r") as f:
+            hosts = json.load(f)
+    # Cache keys start with the address agent_db connects to
+    addresses = set(cache_args.host)
+    for host in hosts:
+        addresses.update([host["ipaddress"], host["hostname"]])
+    prefixes = [f"{address}_" for address in sorted(addresses)] or [""]
+
+    if cache_args.action == "warm":
+        if not hosts:
+            log.log_error_and_exit("agent_db cache warm needs a --batch manifest")
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max(1, cache_args.workers)) as executor:
+            futures = [
+                executor.submit(_run_batch_host, host, statement_config, log)
+                for host in hosts
+            ]
+            failed = 0
+            for host, future in zip(hosts, futures):
+                _output, ok = future.result()
+                failed += not ok
+                print(f"{host['hostname']}: {'OK' if ok else 'failed'}")
+        return 1 if failed else 0
+
+    if cache_args.action == "inspect":
+        now = time.time()
+        for prefix in prefixes:
+            for cache_key, mtime, expires, size in cache_backend.entries(prefix):
+                expires_in = "-" if expires is None else f"{int(expires - now)}s"
+                print(
+                    f"{cache_key} age={int(now - mtime)}s expires_in={expires_in} size={size}"
+                )
+    elif cache_args.action == "purge":
+        removed = sum(cache_backend.purge(prefix) for prefix in prefixes)
+        print(f"Removed {removed} cache entries")
+        removed_locks = cache.purge_lock_files(cache_dir)
+        if removed_locks:
+            print(f"Removed {removed_locks} stale lock files")
+    elif cache_args.action == "size":
+        for name, value in sorted(cache_backend.stats().items()):
+            print(f"{name}: {value}")
+    return 0
+
+
+def install_termination_handlers():
+    """
+    Terminate gracefully on SIGTERM and SIGINT: running queries are cancelled, no
+    further queries are started and the completed sections are written together
+    with agent_db_stats entries for the skipped statements.
+    """
+    from cmk.special_agents.db import basedb
+
+    def terminate(signum, frame):
+        basedb.request_termination()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, terminate)
+
+
+def run_refresh():
+    """
+    Refresh cached statement results, started by BaseDBStrategy._start_background_refresh
+    with the jobs of a run as JSON on stdin. The connection honours the session limit
+    and the circuit breaker like the connections of the agent.
+    """
+    OMD_ROOT = os.environ["OMD_ROOT"]
+
+    refresh = json.load(sys.stdin)
+    params = refresh["strategy_params"]
+    statements = ", ".join(job["statement"] for job in refresh["jobs"])
+    logpath = f"{OMD_ROOT}/var/log/agent_db"
+    if not os.path.exists(logpath):
+        os.makedirs(logpath)
+    log = AgentDBLog(
+        f"{logpath}/{params['db_hostname'] or params['db_host']}.log",
+        params["loglevel"],
+    )
+    statement_config = load_statement_config(OMD_ROOT, log)
+
+    from cmk.special_agents.db import breaker
+    from cmk.special_agents.db import cache
+    from cmk.special_agents.db import writer
+
+    breaker.configure(statement_config.get("circuit_breaker"))
+    cache.configure(statement_config.get("cache"))
+    backend_module = importlib.import_module(refresh["backend"])
+    backend_module.DBStrategy.statement_timeout_sec = refresh["statement_timeout_sec"]
+
+    limiter = get_session_limiter(statement_config, params)
+    slot = None
+    if limiter is not None:
+        slot = limiter.acquire(statement_config["session_limit"].get("wait_sec", 30))
+        if slot is None:
+            log.log.error(
+                f"Background refresh of {statements} skipped, session limit of "
+                f"{limiter.max_sessions} for {limiter.db_host}:{limiter.db_port} reached"
+            )
+            return 0
+    try:
+        # The connection time of the refresh is not reported
+        strategy = backend_module.DBStrategy(
+            **params, output=writer.AgentOutput(io.StringIO())
+        )
+        strategy.session_limiter = limiter
+        if isinstance(strategy.connection, strategy.FormattedErrorMessage):
+            log.log.error(
+                f"Background refresh of {statements} failed: {strategy.connection}"
+            )
+            return 0
+        try:
+            for job in refresh["jobs"]:
+                strategy.refresh_cached_result(job)
+        finally:
+            strategy.close_db_connection()
+    finally:
+        if slot is not None:
+            slot.release()
+    return 0
+
+
+def main(argv=None):
+    """Main function"""
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["cache"]:
+        return run_cache_command(parse_cache_arguments(argv[1:]))
+    if argv[:1] == ["refresh"]:
+        return run_refresh()
+    if "--batch" in argv:
+        install_termination_handlers()
+        return run_batch(parse_batch_arguments(argv))
+    args = parse_arguments(argv)
+
+    if args.hostname:
+        # Output of the host prepared by agent_db --batch --output-mode spool
+        spool_output = read_spool(os.environ["OMD_ROOT"], args.hostname)
+        if spool_output is not None:
+            sys.stdout.write(spool_output)
+            return 0
+
+    socket_path = get_collector_socket_path(os.environ["OMD_ROOT"])
+    if not args.no_collector and os.path.exists(socket_path):
+        from cmk.special_agents.db import collector
+
+        response = collector.query_collector(
+            socket_path, argv, args.collector_timeout
+        )
+        if response is not None:
+            sys.stdout.write(response["output"])
+            if response["exit_code"]:
+                sys.stderr.write(
+                    f"agent_db collector run failed: {response.get('error')}\n"
+                )
+            return response["exit_code"]
+
+    from cmk.special_agents.db import basedb
+
+    install_termination_handlers()
+    try:
+        run_agent(args)
+    except basedb.AgentTerminated as e:
+        # run_agent has written the completed sections and the skipped statements.
+        # Exit with 0, Checkmk would discard the output of a failed special agent.
+        sys.stderr.write(f"agent_db terminated: {e}\n")
+        return 0
 
 
 if __name__ == "__main__":
@@ -7,18 +7,119 @@
 
 import os
 import sys
+import errno
 import json
 import time
 import threading
-import socket
 
 from cmk.special_agents import agent_db
+from cmk.special_agents.db import breaker
 from cmk.special_agents.db import cache
+from cmk.special_agents.db import plan
+from cmk.special_agents.db import runtimes
+from cmk.special_agents.db import schedule
+from cmk.special_agents.db import statements
+from cmk.special_agents.db import writer
+
+
+class AgentTerminated(Exception):
+    """Raised instead of running queries once the agent has been asked to terminate"""
+
+
+class ConnectionBusy(Exception):
+    """Raised if the connection is still in use by a timed out statement, see get_query_lock"""
+
+
+# Set by request_termination, e.g. on SIGTERM
+_termination_requested = threading.Event()
+
+
+def request_termination():
+    """
+    Ask the run to terminate: running queries are cancelled and no further
+    queries and connections are started. Safe to call from a signal handler.
+    """
+    _termination_requested.set()
+
+
+def check_termination():
+    """Raise AgentTerminated if request_termination has been called"""
+    if _termination_requested.is_set():
+        raise AgentTerminated("Skipped, agent_db has been terminated")
+
+
+def fetch_result_set(cursor, batch_size=None):
+    """
+    Yield the rows of the current result set of the cursor.
+
+    Args:
+        cursor: The cursor the statement has been executed with.
+        batch_size: Fetch the rows in lists of at most batch_size rows with fetchmany.
+            By default all rows are fetched as one list.
+    """
+    if not batch_size:
+        yield cursor.fetchall()
+        return
+    rows = cursor.fetchmany(batch_size)
+    # An empty result set still yields one empty list, like fetchall
+    yield rows
+    while rows:
+        rows = cursor.fetchmany(batch_size)
+        if rows:
+            yield rows
+
+
+class StreamedSection:
+    """
+    Section content of a streamed statement, rendered batch by batch into a spool
+    file which is kept in memory up to a size limit.
+    """
+
+    def __init__(self, spool):
+        self.spool = spool
+
+    def write_to(self, output):
+        """Write the section to output chunk by chunk"""
+        self.spool.seek(0)
+        while True:
+            chunk = self.spool.read(65536)
+            if not chunk:
+                break
+            output.write(chunk)
+        self.spool.close()
+
+    def read(self):
+        self.spool.seek(0)
+        text = self.spool.read()
+        self.spool.close()
+        return text
 
 
 class BaseDBStrategy(agent_db.AgentDBLog):
     """Base DB Strategy Implementation"""
 
+    # Seconds to wait for a timed out statement to end after it has been cancelled
+    cancel_grace_sec = 2
+    # Cheap statement to check if a kept connection is still usable
+    ping_statement = "SELECT 1"
+    # Seconds a detected database version is reused before it is queried again
+    version_cache_sec = 3600
+    # Site-wide session limit of the database server, set by DBHandler
+    session_limiter = None
+    # Statements whose transformation needs the complete result, never streamed
+    unstreamable_statements = ()
+    # Rendered sections of streamed statements above this size are spooled to disk
+    stream_spool_bytes = 4 * 1024 * 1024
+    # Time by which all statements of the run have to be done, set by DBHandler
+    # if a run deadline is configured
+    run_deadline = None
+    # Statements are not started with less time left until the run deadline. The
+    # backends' statement timeouts treat 0 as no limit.
+    min_query_budget_sec = 1.0
+    # Longest statement timeout of the backend configuration, set by DBHandler. For
+    # drivers whose statement timeout is set once when a connection is opened.
+    statement_timeout_sec = None
+
     def __init__(
         self,
         db_host,
@@ -30,9 +131,14 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         db_instance,
         db_cursor_timeout_sec,
         loglevel,
+        output=None,
+        probe_time=None,
     ):
         self.omd_root = os.environ["OMD_ROOT"]
-        super().__init__(f"{self.omd_root}/var/log/agent_db/{db_host}.log", loglevel)
+        # Log to the log file of the Checkmk host, like the DBHandler of the run
+        super().__init__(
+            f"{self.omd_root}/var/log/agent_db/{db_hostname or db_host}.log", loglevel
+        )
 
         self.omd_tmp = self.omd_root + "/var/tmp/agent_db"
         # Create the tmp directory if it does not exist
@@ -42,12 +148,49 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
 
+        # Parameters of the strategy, a background refresh creates its strategy with them
+        self.strategy_params = {
+            "db_host": db_host,
+            "db_hostname": db_hostname,
+            "db_user": db_user,
+            "db_pass": db_pass,
+            "db_cstr": db_cstr,
+            "db_port": db_port,
+            "db_instance": db_instance,
+            "db_cursor_timeout_sec": db_cursor_timeout_sec,
+            "loglevel": loglevel,
+        }
         self.sql_statement_folder = None  # To be set in subclass
         self.db_host = db_host
         self.db_hostname = db_hostname
         self.db_port = db_port
         self.db_cstr = db_cstr
         self.db_cursor_timeout_sec = db_cursor_timeout_sec
+        # Sections are written to output, a writer.AgentOutput. DBHandler passes the
+        # output of the run or a child buffer of a connection processed in parallel.
+        self.output = output if output is not None else writer.AgentOutput(sys.stdout)
+        # Per thread state, e.g. the separator of the statement rendered by the thread
+        self._thread_state = threading.local()
+        # Duration of the TCP pre-flight probe by DBHandler, reported with the connection time
+        self.probe_time = probe_time
+        # Session slots (see limiter.SessionLimiter) held by the connections
+        self.session_slots = []
+        # Background refreshes of the run by cache key, see _refresh_in_background
+        self._refresh_jobs = {}
+        # Shared state of failed connection attempts, None if disabled
+        self.circuit_breaker = breaker.get_circuit_breaker(
+            self.omd_tmp + "/breaker", db_host, db_port, db_cstr
+        )
+        # Set if the connection was skipped because the circuit breaker is open
+        self.circuit_open = False
+        # Expected runtimes of the statements, used with a run deadline
+        self.runtime_history = runtimes.RuntimeHistory(
+            self.omd_tmp + "/runtimes", db_host, db_port, db_cstr
+        )
+        # Last runs of the statements with an interval_min
+        self.statement_schedule = schedule.StatementSchedule(
+            self.omd_tmp + "/schedule", db_host, db_port, db_cstr
+        )
         self.log.debug("Initializing Base DB Strategy")
 
         # Initialize the database connection
@@ -67,8 +210,79 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         raise NotImplementedError("Not implemented for this backend")
 
     def close_db_connection(self):
-        if self.connection is not None:
-            self.connection.close()
+        try:
+            for connection in getattr(self, "pool_connections", []):
+                connection.close()
+            if self.connection is not None:
+                self.connection.close()
+        finally:
+            self.release_session_slots()
+
+    def release_session_slots(self):
+        for slot in self.session_slots:
+            slot.release()
+        self.session_slots = []
+
+    def reuse_connection(self, output=None):
+        """
+        Prepare a strategy kept by the collector daemon for another run.
+        The connection is checked with ping_statement, whose round trip time is
+        reported as connection time of the run.
+
+        Args:
+            output: AgentOutput the sections of the next run are written to.
+
+        Returns:
+            bool: True if the connection is still usable, False otherwise.
+        """
+        self.output = output if output is not None else writer.AgentOutput(sys.stdout)
+        self.probe_time = None
+        try:
+            start_ping = time.time()
+            cursor = self.connection.cursor()
+            cursor.execute(self.ping_statement)
+            cursor.fetchall()
+            cursor.close()
+        except Exception as e:
+            self.log.debug(f"Ping of kept connection to {self.db_cstr} failed: {e}")
+            return False
+        self.print_backend_connection_time(
+            self.backend, self.db_cstr, time.time() - start_ping
+        )
+        return True
+
+    def open_connection(self):
+        """
+        Open and return a new connection to the database of this strategy.
+        Used for additional connections of the statement connection pool.
+        """
+        raise NotImplementedError("Not implemented for this backend")
+
+    def open_guarded_connection(self):
+        """
+        Open the default connection, unless the circuit breaker of the database is
+        open. The outcome of the attempt is recorded in the circuit breaker.
+
+        Raises:
+            breaker.CircuitOpenError: If the breaker is open, the database is not contacted.
+        """
+        if self.circuit_breaker is None:
+            return self.open_connection()
+
+        try:
+            self.circuit_breaker.before_connect()
+        except breaker.CircuitOpenError:
+            self.circuit_open = True
+            raise
+        try:
+            connection = self.open_connection()
+        except Exception as e:
+            self.circuit_breaker.record_failure(e)
+            raise
+        if self.circuit_breaker.record_success():
+            # The database may have been upgraded while it was unreachable
+            self.invalidate_version_cache()
+        return connection
 
     def create_db_connection(self, db_host, db_user, db_pass, db_cstr, db_port):
         # To be implemented in subclass
@@ -82,19 +296,93 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         # To be implemented in subclass
         pass
 
-    @staticmethod
-    def is_version_string(mystery_string):
-        return all(c in ".0123456789" for c in mystery_string)
+    def query_version(self):
+        """
+        Query the version of the database.
 
-    @staticmethod
-    def comparable_version_from_string(version_string):
+        Returns:
+            dict: {"version": str} plus backend specific details needed by
+            print_version_section, e.g. the Oracle version banner.
         """
-        Turn a version string into an object we can sort and compare
+        return {"version": self.get_version()}
 
-        This only works for version strings like 1.0.4 or 304
-        but not for c1.23.4r5 or 1.3.0p24
+    def print_version_section(self, version_info):
+        # Sections derived from the version, to be implemented in subclass
+        pass
+
+    def _version_cache_key(self):
+        return cache.generate_cache_key(
+            self.db_host, self.db_cstr, f"db_version_{self.db_port}"
+        )
+
+    def get_db_version(self, statement_cfg):
+        """
+        Get the version of the database, which selects the statement files.
+        The version is cached per host, port and connection string for
+        version_cache_sec seconds. Once half of that time has passed, the version
+        is queried again after the statements have been executed, so a live
+        query is only needed for new connections and after connection errors.
+
+        Args:
+            statement_cfg (dict): Configuration of the backend.
+
+        Returns:
+            str: The version of the database.
         """
-        return tuple([int(ver) for ver in version_string.split(".")])
+        self.version_cache_sec = statement_cfg.get(
+            "version_cache_sec", self.version_cache_sec
+        )
+        self.version_refresh_due = False
+        cached = None
+        if self.version_cache_sec:
+            cached = cache.get_cache(
+                self._version_cache_key(), self.cache_dir, self.version_cache_sec
+            )
+
+        if cached is None:
+            version_info = self.query_version()
+            if self.version_cache_sec:
+                self._write_cache(
+                    self._version_cache_key(),
+                    version_info,
+                    self.version_cache_sec,
+                )
+        else:
+            mtime_cache_file, version_info = cached
+            self.log.debug(f"Using cached version {version_info['version']}")
+            self.version_refresh_due = (
+                time.time() - mtime_cache_file > self.version_cache_sec / 2
+            )
+
+        self.print_version_section(version_info)
+        return version_info["version"]
+
+    def refresh_version_cache(self):
+        """Query the version again if get_db_version has served an aging value"""
+        if not getattr(self, "version_refresh_due", False):
+            return
+        self.version_refresh_due = False
+        try:
+            version_info = self.query_version()
+        except (Exception, SystemExit) as e:
+            self.log.debug(f"Refreshing the version of {self.db_cstr} failed: {e}")
+            return
+        self._write_cache(
+            self._version_cache_key(), version_info, self.version_cache_sec
+        )
+
+    def invalidate_version_cache(self):
+        try:
+            cache.delete_cache(self.cache_dir, self._version_cache_key())
+        except cache.CacheWriteError as e:
+            self.log.error(str(e))
+
+    def _write_cache(self, cache_key, data, cache_time_sec=None):
+        """Write a cache entry, a failing cache only costs the cached result"""
+        try:
+            cache.write_cache(self.cache_dir, cache_key, data, cache_time_sec)
+        except cache.CacheWriteError as e:
+            self.log.error(str(e))
 
     def transform_subresult(self, statement_name, subresult):
         # To be implemented in subclass
@@ -128,96 +416,21 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         cmk_header += ">>>"
         return cmk_header
 
-    def find_suitable_version(self, sql_version_numbers, db_version):
-        # Find out the closest version number
-        # Example list: version_numbers = [121, 92]
-
-        # If there is a version number in the list of sql_version_numbers which is smaller than the db_version number then use this one.
-        # In case that there are more then one version is smaller than the db_version number then use the highest one.
-        # Example: db_version = 190, sql_version_numbers = [121, 92] --> closest_version = 121
-        # Filter version numbers to those smaller than db_version
-        versions_smaller_than_db = [
-            version_number
-            for version_number in sql_version_numbers
-            if version_number <= self.comparable_version_from_string(db_version)
-        ]
-
-        if versions_smaller_than_db:
-            closest_version = max(versions_smaller_than_db)
-            return closest_version
-        else:
-            return None
-
     def read_statement(self, statement, db_version):
-        # Example Versions 92, 102, 121, 180, 213
-        # Read SQL statement from file and return statement
-        # If there are no statement files with a version number, use the statement without a version number
-        # elif there is a file with the exact suffix _<version> then use this one.
-        # else use the number which is closest to the version number
-
+        # Read SQL statement from file and return statement, see
+        # statements.StatementRepository for the selection of the version
         self.log.debug(f"Reading statement {statement} for version {db_version}")
 
-        # Get the list of files in the statement folder
-        statement_files = os.listdir(self.sql_statement_folder)
-
-        # Filter the files based on the statement and version
-        filtered_files = [
-            filename
-            for filename in statement_files
-            if filename.startswith(f"{statement}_")
-            and self.is_version_string(filename.rsplit("_", 1)[1][:-4])
-        ]
-        sql_version_numbers = [
-            self.comparable_version_from_string(filename.rsplit("_", 1)[1][:-4])
-            for filename in filtered_files
-        ]
-
-        closest_version = self.find_suitable_version(sql_version_numbers, db_version)
-
-        if closest_version is not None:
-            closest_version_string = ".".join(map(str, closest_version))
-            statement_file = (
-                f"{self.sql_statement_folder}/{statement}_{closest_version_string}.sql"
-            )
-        else:
-            self.log.debug(
-                f"No explicit version found for statement {statement} and version {db_version}"
+        repository = statements.get_repository(self.sql_statement_folder)
+        statement_file = repository.resolve(statement, db_version)
+        if statement_file is None:
+            self.log.error(
+                f"No statement file found for statement {statement} and version {db_version}"
             )
-            # Try to fallback to the statement without a version number if file exists
-            statement_file = f"{self.sql_statement_folder}/{statement}.sql"
-            if not os.path.exists(statement_file):
-                self.log.error(
-                    f"No fallback statement file without version number found"
-                )
-                return None
+            return None
 
         self.log.debug(f"Reading statement {statement} from {statement_file}")
-        # Read the statement from the selected file
-        with open(statement_file, "r") as sqlfile:
-            sql_statement = sqlfile.read()
-
-        # Remove trailing newline and semicolon from the statement
-        sql_statement = sql_statement.rstrip("\n").rstrip(";")
-        return sql_statement
-
-    def extract_packages_from_backend_params(self, backend_params):
-        """
-        Extract the packages from the backend parameters.
-
-        Args:
-            backend_params (dict): Backend parameters.
-
-        Returns:
-            list: List of packages extracted from the backend parameters.
-        """
-        packages = []
-        for key in backend_params:
-            # If key ends with "_pkgs" then it should be package list
-            # To ensure that keep that in mind while defining the backend parameters in wato
-            if key.endswith("_pkgs"):
-                packages.extend(backend_params[key])
-
-        return packages
+        return repository.read(statement, db_version)
 
     def exec_statements(self, statement_cfg, backend_params, params):
         """
@@ -235,61 +448,143 @@ class BaseDBStrategy(agent_db.AgentDBLog):
                 "No statement description found in agent configuration!"
             )
 
-        db_version = self.get_version()
-
-        for statement_name, state_statement_cfg in statement_cfg[
-            "statement_desc"
-        ].items():
-            if self._is_statement_matching(state_statement_cfg, backend_params):
-                self.log.debug(f"Select connection for statement: {statement_name}")
-                connection = self._select_connection(state_statement_cfg, params)
-
-                execution_scope = state_statement_cfg.get("execution_scope")
-                # Flags for checking execution scope criteria
-                connection_string_match = True
-                db_hostname_match = True
-
-                # If execution_scope is defined, check individual conditions
-                if execution_scope:
-                    # Check if the current database connection string is in the execution scope, if defined
-                    if "connection_string" in execution_scope:
-                        connection_string_match = (
-                            self.db_cstr in execution_scope["connection_string"]
-                        )
+        self.cancel_grace_sec = statement_cfg.get(
+            "cancel_grace_sec", self.cancel_grace_sec
+        )
+        db_version = self.get_db_version(statement_cfg)
+        # Part of the cache keys, see cache.generate_cache_key
+        self.db_version = db_version
+
+        # Statements of the host's packages within their execution scope, in statement_desc order
+        statement_plan = plan.get_statement_plan(
+            statement_cfg["statement_desc"],
+            backend_params,
+            self.db_cstr,
+            self.db_hostname,
+        )
+        self.log.debug(
+            f"Statement plan for {self.db_cstr}: {[name for name, _cfg in statement_plan]}"
+        )
 
-                    # Check if the current database hostname is in the execution scope, if defined
-                    if "db_hostname" in execution_scope:
-                        db_hostname_match = (
-                            self.db_hostname in execution_scope["db_hostname"]
-                        )
+        planned_statements = []
+        for statement_name, state_statement_cfg in statement_plan:
+            self.log.debug(f"Select connection for statement: {statement_name}")
+            connection = self._select_connection(state_statement_cfg, params)
+            planned_statements.append(
+                (statement_name, state_statement_cfg, connection)
+            )
 
-                # Execute statement if both conditions (if defined) are met
-                if connection_string_match and db_hostname_match:
-                    self._execute_statement(
-                        statement_name,
-                        state_statement_cfg,
-                        connection,
-                        db_version,
-                        statement_cfg,
-                    )
-                else:
-                    self.log.debug(f"Statement {statement_name} not in execution scope")
+        if self.run_deadline is not None:
+            # Statements with the highest priority first, the cheapest ones of a
+            # priority before the expensive ones
+            planned_statements.sort(
+                key=lambda planned: self._run_order_key(planned[0], planned[1])
+            )
 
-    def _is_statement_matching(self, state_statement_cfg, backend_params):
+        try:
+            statement_workers = int(statement_cfg.get("statement_workers", 1))
+            if statement_workers > 1 and len(planned_statements) > 1:
+                self._execute_statements_pooled(
+                    planned_statements, db_version, statement_cfg, statement_workers
+                )
+            else:
+                for index, (
+                    statement_name,
+                    state_statement_cfg,
+                    connection,
+                ) in enumerate(planned_statements):
+                    try:
+                        self._execute_statement(
+                            statement_name,
+                            state_statement_cfg,
+                            connection,
+                            db_version,
+                            statement_cfg,
+                        )
+                    except AgentTerminated as e:
+                        self.output.add_skipped_statements(
+                            self.db_cstr,
+                            [name for name, _cfg, _conn in planned_statements[index:]],
+                            str(e),
+                        )
+                        raise
+        finally:
+            self.statement_schedule.save()
+            if self.run_deadline is not None:
+                self.runtime_history.save()
+            self._start_background_refresh()
+
+        self.refresh_version_cache()
+
+    def _run_order_key(self, statement_name, state_statement_cfg):
+        expected_runtime = self.runtime_history.get(statement_name)
+        return (
+            -state_statement_cfg.get("priority", 0),
+            expected_runtime if expected_runtime is not None else 0.0,
+        )
+
+    def exec_cached_statements(self, statement_cfg, backend_params):
         """
-        Determine if the statement matches the backend parameters.
+        Output the cached results of the statements without querying the database,
+        e.g. while its circuit breaker is open. Statements without a valid cached
+        result are left out.
 
         Args:
-            state_statement_cfg (dict): Configuration of the current statement.
+            statement_cfg (dict): Configuration for the statements to be executed.
             backend_params (dict): Backend parameters.
 
         Returns:
-            bool: True if the statement matches, False otherwise.
+            None
         """
-        for pkg in self.extract_packages_from_backend_params(backend_params):
-            if pkg in state_statement_cfg["packages"]:
-                return True
-        return False
+        # Cache keys depend on the database version, which can't be queried now
+        cached_version = cache.get_cache(
+            self._version_cache_key(),
+            self.cache_dir,
+            statement_cfg.get("version_cache_sec", self.version_cache_sec),
+        )
+        if cached_version is None:
+            self.log.debug(f"No cached version of {self.db_cstr}, no cached results")
+            return
+        version_info = cached_version[1]
+        self.db_version = version_info["version"]
+        self.print_version_section(version_info)
+
+        statement_plan = plan.get_statement_plan(
+            statement_cfg["statement_desc"],
+            backend_params,
+            self.db_cstr,
+            self.db_hostname,
+        )
+        for statement_name, state_statement_cfg in statement_plan:
+            prepared = self._prepare_statement(
+                statement_name, state_statement_cfg, self.db_version, statement_cfg
+            )
+            if prepared is None or prepared["cache_time_sec"] is None:
+                continue
+            cache_key = prepared["rendered_cache_key"] or cache.generate_cache_key(
+                self.db_host,
+                self.db_cstr,
+                statement_name,
+                prepared["sql_statement"],
+                self.db_version,
+            )
+            cache_result = self._get_cached_result(
+                cache_key, prepared["cache_time_sec"]
+            )
+            if cache_result is None:
+                continue
+            self.log.debug(f"Serving cached result of {statement_name}")
+            mtime_cache_file, cached_data = cache_result
+            stats = {
+                "status": "OK",
+                "runtime": 0.0,
+                "exception": None,
+                "timeout": prepared["timeout"],
+            }
+            self.print_db_stats(self.db_cstr, statement_name, stats)
+            self._output_prepared_statement(
+                prepared, cached_data, mtime_cache_file, stats
+            )
 
     def _select_connection(self, state_statement_cfg, params):
         """
@@ -304,29 +599,33 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         """
         return self.connection  # Default connection
 
-    def _execute_statement(
-        self, statement_name, state_statement_cfg, connection, db_version, statement_cfg
+    def _prepare_statement(
+        self, statement_name, state_statement_cfg, db_version, statement_cfg
     ):
         """
-        Execute a single statement using the provided connection.
+        Collect everything needed to execute and output a single statement.
 
         Args:
             statement_name (str): The name of the statement.
             state_statement_cfg (dict): Configuration of the current statement.
-            connection: The connection object to use for executing the statement.
             db_version (str): The version of the database.
             statement_cfg (dict): Configuration for all statements.
 
         Returns:
-            None
+            dict: The prepared statement or None if there is no statement file.
         """
-        self.separator = state_statement_cfg.get(
+        separator = state_statement_cfg.get(
             "separator", statement_cfg.get("default_separator")
         )
         sqlstatement_timeout = state_statement_cfg.get(
             "timeout_sec", statement_cfg.get("default_timeout_sec", 15)
         )
         cache_time_sec = cache.get_cache_time_in_seconds(state_statement_cfg)
+        refresh_after_sec = cache.get_refresh_time_in_seconds(state_statement_cfg)
+        interval_sec = schedule.get_interval_in_seconds(state_statement_cfg)
+        if interval_sec is not None and cache_time_sec is None:
+            # The result is served from cache until the statement is due again
+            cache_time_sec = 2 * interval_sec
 
         self.log.debug(f"Statement: {statement_name}, cache_time_sec: {cache_time_sec}")
 
@@ -337,19 +636,275 @@ class BaseDBStrategy(agent_db.AgentDBLog):
             self.log.error(
                 f"Skipping execution of statement {statement_name} due to missing statement file"
             )
+            return None
+
+        # Render the rows batch by batch while they are fetched, see _query
+        stream_batch_rows = None
+        if (
+            check_header != "custom_sql"
+            and statement_name not in self.unstreamable_statements
+            and state_statement_cfg.get("stream", statement_cfg.get("stream", False))
+        ):
+            stream_batch_rows = statement_cfg.get("stream_batch_rows", 1000)
+
+        # Cache the rendered section instead of the rows, custom_sql needs the rows.
+        # Streamed statements don't keep their rows, they always cache the section.
+        rendered_cache_key = None
+        if (
+            cache_time_sec is not None
+            and check_header != "custom_sql"
+            and (
+                stream_batch_rows
+                or state_statement_cfg.get(
+                    "cache_rendered", statement_cfg.get("cache_rendered", False)
+                )
+            )
+        ):
+            rendered_cache_key = cache.generate_rendered_cache_key(
+                cache.generate_cache_key(
+                    self.db_host,
+                    self.db_cstr,
+                    statement_name,
+                    sql_statement,
+                    db_version,
+                ),
+                self.backend,
+                check_header,
+                separator,
+            )
+
+        return {
+            "statement_name": statement_name,
+            "state_statement_cfg": state_statement_cfg,
+            "separator": separator,
+            "timeout": sqlstatement_timeout,
+            "cache_time_sec": cache_time_sec,
+            "refresh_after_sec": refresh_after_sec,
+            "interval_sec": interval_sec,
+            "check_header": check_header,
+            "sql_statement": sql_statement,
+            "rendered_cache_key": rendered_cache_key,
+            "stream_batch_rows": stream_batch_rows,
+        }
+
+    def _execute_statement(
+        self, statement_name, state_statement_cfg, connection, db_version, statement_cfg
+    ):
+        """
+        Execute a single statement using the provided connection.
+
+        Args:
+            statement_name (str): The name of the statement.
+            state_statement_cfg (dict): Configuration of the current statement.
+            connection: The connection object to use for executing the statement.
+            db_version (str): The version of the database.
+            statement_cfg (dict): Configuration for all statements.
+
+        Returns:
+            None
+        """
+        prepared = self._prepare_statement(
+            statement_name, state_statement_cfg, db_version, statement_cfg
+        )
+        if prepared is None:
             return
 
-        result, mtime_cache_file = self.exec_sql(
+        result, mtime_cache_file, stats = self._run_sql(
             connection,
             statement_name,
-            sql_statement,
-            sqlstatement_timeout,
-            cache_time_sec,
+            prepared["sql_statement"],
+            prepared["timeout"],
+            prepared["cache_time_sec"],
+            prepared["refresh_after_sec"],
+            prepared,
+        )
+        self.print_db_stats(self.db_cstr, statement_name, stats)
+        self._output_prepared_statement(prepared, result, mtime_cache_file, stats)
+        self.output.flush(force=False)
+
+    def _output_prepared_statement(self, prepared, result, mtime_cache_file, stats):
+        if result is None:
+            # Skipped because of the run deadline, see _skip_for_run_deadline
+            return
+        self.separator = prepared["separator"]
+        if isinstance(result, StreamedSection):
+            self._output_streamed_section(prepared, result, stats)
+            return
+        if prepared["rendered_cache_key"] is None:
+            self._output_result(
+                prepared["check_header"],
+                result,
+                prepared["state_statement_cfg"],
+                mtime_cache_file,
+                prepared["cache_time_sec"],
+            )
+            return
+
+        if isinstance(result, cache.RenderedSection):
+            # Cache hit, the section is written as it has been cached
+            section = result.text
+        else:
+            section = self._render_prepared(prepared, result)
+            if stats["status"] == "OK":
+                self._write_cache(
+                    prepared["rendered_cache_key"],
+                    cache.RenderedSection(section),
+                    prepared["cache_time_sec"],
+                )
+            if prepared.get("single_flight") is not None:
+                prepared.pop("single_flight").release()
+        self.output.write(
+            self.cmk_header(
+                prepared["check_header"],
+                self.separator,
+                mtime_cache_file,
+                prepared["cache_time_sec"],
+            )
+            + "\n"
         )
+        self.output.write(section)
 
-        self._output_result(
-            check_header, result, state_statement_cfg, mtime_cache_file, cache_time_sec
+    def _output_streamed_section(self, prepared, section, stats):
+        self.output.write(
+            self.cmk_header(
+                prepared["check_header"],
+                self.separator,
+                None,
+                prepared["cache_time_sec"],
+            )
+            + "\n"
         )
+        if prepared["rendered_cache_key"] is not None and stats["status"] == "OK":
+            # The cache entry needs the complete section, it is read only once for
+            # the output and the cache
+            text = section.read()
+            self.output.write(text)
+            self._write_cache(
+                prepared["rendered_cache_key"],
+                cache.RenderedSection(text),
+                prepared["cache_time_sec"],
+            )
+        else:
+            section.write_to(self.output)
+        if prepared.get("single_flight") is not None:
+            prepared.pop("single_flight").release()
+
+    def _render_prepared(self, prepared, result):
+        if isinstance(result, StreamedSection):
+            return result.read()
+        self.separator = prepared["separator"]
+        return "".join(
+            self.output_statement_result(
+                prepared["check_header"], prepared["check_header"], result
+            )
+        )
+
+    def _open_connection_pool(self, size):
+        """
+        Build a pool of up to size connections, starting with the default connection.
+        If additional connections cannot be opened, the pool stays smaller.
+        Connections opened for a previous run of a kept strategy are reused.
+        """
+        if not hasattr(self, "pool_connections"):
+            self.pool_connections = []
+        while len(self.pool_connections) < size - 1:
+            slot = None
+            if self.session_limiter is not None:
+                # Additional connections only use free sessions, they never wait
+                slot = self.session_limiter.acquire()
+                if slot is None:
+                    self.log.debug("Session limit reached, no additional pool connection")
+                    break
+            try:
+                self.pool_connections.append(self.open_connection())
+            except Exception as e:
+                if slot is not None:
+                    slot.release()
+                self.log.error(f"Could not open additional pool connection: {e}")
+                break
+            if slot is not None:
+                self.session_slots.append(slot)
+
+        import queue
+
+        pool = queue.Queue()
+        for connection in [self.connection] + self.pool_connections[: size - 1]:
+            pool.put(connection)
+        self.log.debug(f"Statement connection pool size: {pool.qsize()}")
+        return pool
+
+    def _execute_statements_pooled(
+        self, planned_statements, db_version, statement_cfg, statement_workers
+    ):
+        """
+        Execute the statements with a pool of connections. The queries run in
+        parallel, while the agent_db_stats entries and sections are written in the
+        same order as in the sequential case.
+
+        Args:
+            planned_statements (list): (statement_name, state_statement_cfg, connection) tuples.
+            db_version (str): The version of the database.
+            statement_cfg (dict): Configuration for all statements.
+            statement_workers (int): Maximum number of parallel connections.
+
+        Returns:
+            None
+        """
+        jobs = []
+        for statement_name, state_statement_cfg, connection in planned_statements:
+            prepared = self._prepare_statement(
+                statement_name, state_statement_cfg, db_version, statement_cfg
+            )
+            if prepared is not None:
+                jobs.append((prepared, connection))
+
+        pool = self._open_connection_pool(min(statement_workers, len(jobs)))
+
+        def run_job(prepared, connection):
+            # Statements on a special connection (e.g. Oracle ASM) use it directly,
+            # all others borrow a connection from the pool.
+            pooled = connection is self.connection
+            if pooled:
+                connection = pool.get()
+            try:
+                return self._run_sql(
+                    connection,
+                    prepared["statement_name"],
+                    prepared["sql_statement"],
+                    prepared["timeout"],
+                    prepared["cache_time_sec"],
+                    prepared["refresh_after_sec"],
+                    prepared,
+                )
+            finally:
+                if pooled:
+                    pool.put(connection)
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=pool.qsize()) as executor:
+            futures = [
+                executor.submit(run_job, prepared, connection)
+                for prepared, connection in jobs
+            ]
+            terminated = None
+            for (prepared, _connection), future in zip(jobs, futures):
+                try:
+                    result, mtime_cache_file, stats = future.result()
+                except AgentTerminated as e:
+                    # Statements completed by other workers are still written
+                    terminated = e
+                    self.output.add_skipped_statements(
+                        self.db_cstr, [prepared["statement_name"]], str(e)
+                    )
+                    continue
+                self.print_db_stats(self.db_cstr, prepared["statement_name"], stats)
+                self._output_prepared_statement(
+                    prepared, result, mtime_cache_file, stats
+                )
+                self.output.flush(force=False)
+        if terminated is not None:
+            raise terminated
 
     def _output_result(
         self,
@@ -372,7 +927,7 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         Returns:
             None
         """
-        sys.stdout.write(
+        self.output.write(
             self.cmk_header(
                 check_header, self.separator, mtime_cache_file, cache_time_sec
             )
@@ -391,14 +946,21 @@ class BaseDBStrategy(agent_db.AgentDBLog):
                 self.output_statement_result(check_header, check_header, result)
             )
             checkoutput.update(state_statement_cfg)
-            sys.stdout.write(json.dumps(checkoutput) + "\n")
+            self.output.write(json.dumps(checkoutput) + "\n")
         else:
             for line in self.output_statement_result(
                 check_header, check_header, result
             ):
-                checkoutput["result"] += line
+                self.output.write(line)
 
-            sys.stdout.write(checkoutput["result"])
+    @property
+    def separator(self):
+        # Statements are rendered in parallel by query threads when streamed
+        return getattr(self._thread_state, "separator", None)
+
+    @separator.setter
+    def separator(self, value):
+        self._thread_state.separator = value
 
     @property
     def separator_char(self):
@@ -421,9 +983,10 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         return separator
 
     @staticmethod
-    def query(cursor, sqlstatement):
+    def query(cursor, sqlstatement, batch_size=None):
         """
         Run an SQL statement with an open cursor.
+        With batch_size, every result set is yielded in lists of at most batch_size rows.
 
         Overriding this method allows different strategies for different DBs
         """
@@ -434,8 +997,7 @@ class BaseDBStrategy(agent_db.AgentDBLog):
 
         for sql in sqls:
             cursor.execute(sql)
-            ret = cursor.fetchall()
-            yield ret
+            yield from fetch_result_set(cursor, batch_size)
 
     def format_error_message(self, db_cstr, exception, timeout=False):
         if timeout:
@@ -452,45 +1014,44 @@ class BaseDBStrategy(agent_db.AgentDBLog):
         self, backend: str, db_cstr: str, connection_time: float, error=None
     ):
         """
-        Print the backend_connection_time statment statistics.
+        Add the backend_connection_time statment statistics to the output, which
+        writes the entries of all connections as one section.
 
         Args:
             db_cstr: The connection string of the database.
             connection_time: The time taken to establish the connection.
             error: The error message if the connection failed.
         """
-        separator = 0
-        if error:
-            # cast error to string
-            error = str(error)
-
-        connection_stats = {
-            "db_cstr": db_cstr,
-            "connection_time": connection_time,
-            "error": error,
-        }
-        print(self.cmk_header(f"{backend}_connection_time", separator))
-        # if error:
-        #    print(f"{db_cstr} {connection_time} {error}", file=sys.stdout)
-        # else:
-        #    print(f"{db_cstr} {connection_time}", file=sys.stdout)
-        print(json.dumps(connection_stats))
+        if error and self.circuit_breaker is None:
+            # The database may have been upgraded, detect its version again.
+            # With a circuit breaker this is done once the database is back, the
+            # version is needed to serve cached results meanwhile.
+            self.invalidate_version_cache()
+        self.output.add_connection_time(
+            backend, db_cstr, connection_time, error, self.probe_time
+        )
 
     def print_db_stats(self, db_cstr, statement, stats):
         """
-        Print the agent_db_stats statment statistics.
+        Add the agent_db_stats statment statistics to the output, which writes
+        the entries of all statements as one section.
 
         Args:
             db_cstr: The connection string of the database.
             statement: The SQL statement being executed.
             stats: The statistics data to print as json checkoutput.
         """
-        print("<<<agent_db_stats:sep(0)>>>")
-        db_stats = {db_cstr: {statement: stats}}
-        print(json.dumps(db_stats))
+        self.output.add_db_stats(db_cstr, statement, stats)
 
-    def exec_sql(
-        self, db, statement, sqlstatement, sqlstatement_timeout, cache_time_sec=None
+    def _run_sql(
+        self,
+        db,
+        statement,
+        sqlstatement,
+        sqlstatement_timeout,
+        cache_time_sec=None,
+        refresh_after_sec=None,
+        prepared=None,
     ):
         """
         Execute a Query against the given db conn object. Open a cursor, handle timeout, and utilize caching if specified.
@@ -501,79 +1062,527 @@ class BaseDBStrategy(agent_db.AgentDBLog):
             sqlstatement: The SQL statement to execute.
             sqlstatement_timeout: The timeout value for the SQL statement execution.
             cache_time_sec: The time duration to cache the query result (optional).
+            refresh_after_sec: Age after which a cached result is refreshed in the background (optional).
+            prepared: The prepared statement, see _prepare_statement (optional).
 
         Returns:
-            A tuple containing the query results and the modification time of the cache file (if caching is enabled).
+            A tuple containing the query results, the modification time of the cache file (if caching is enabled) and the statement stats.
+            With a rendered_cache_key, a cache hit returns a cache.RenderedSection instead
+            of the rows, and rows of a cache miss are cached by _output_prepared_statement.
         """
-        stats = {
-            "status": None,
-            "runtime": None,
-            "exception": None,
-            "timeout": sqlstatement_timeout,
-        }
-        results = []
         cache_key = None
-        mtime_cache_file = None
+        rendered_cache_key = prepared["rendered_cache_key"] if prepared else None
+        flight = None
+        cache_result = None
+        query_timeout = sqlstatement_timeout
 
         if cache_time_sec is not None:
             # Generate a cache key for the SQL statement
-            cache_key = cache.generate_cache_key(self.db_host, self.db_cstr, statement)
-            # Attempt to retrieve the query result from the cache
-            cache_result = cache.get_cache(cache_key, self.cache_dir, cache_time_sec)
+            cache_key = rendered_cache_key or cache.generate_cache_key(
+                self.db_host,
+                self.db_cstr,
+                statement,
+                sqlstatement,
+                getattr(self, "db_version", None),
+            )
+            if self._is_due(statement, prepared):
+                # Due in this interval, the cached result of the last run is replaced
+                self.log.debug(f"Statement {statement} is due")
+            else:
+                # Attempt to retrieve the query result from the cache
+                cache_result = self._get_cached_result(cache_key, cache_time_sec)
+
+        if (
+            cache_result is None
+            and prepared is not None
+            and self.run_deadline is not None
+        ):
+            query_timeout, skip_reason = self._get_query_budget(
+                statement, sqlstatement_timeout
+            )
+            if skip_reason is not None:
+                return self._skip_for_run_deadline(
+                    statement, cache_key, sqlstatement_timeout, skip_reason
+                )
+
+        if cache_time_sec is not None:
+            if cache_result is None and cache.is_single_flight_enabled():
+                # Only one process runs the query of a cache key at a time, others
+                # (e.g. hosts sharing a database) wait for it and use its result
+                flight = cache.SingleFlight(self.cache_dir, cache_key)
+                flight.acquire(query_timeout + self.cancel_grace_sec)
+                if flight.waited:
+                    self.log.debug(f"Waited for concurrent query of {statement}")
+                    cache_result = self._get_cached_result(cache_key, cache_time_sec)
+                if cache_result is not None:
+                    flight.release()
+
             if cache_result is not None:
                 # Cache hit, use the cached result
                 self.log.debug(
                     f"Cache hit for: {self.db_host} {self.db_cstr} {statement}"
                 )
                 mtime_cache_file, cached_data = cache_result
-                stats["status"] = "OK"
-                stats["runtime"] = 0.0
-                results = cached_data
-                self.print_db_stats(self.db_cstr, statement, stats)
-                return (results, mtime_cache_file)
+                if (
+                    refresh_after_sec is not None
+                    and time.time() - mtime_cache_file
+                    >= cache.get_jittered_time(refresh_after_sec, cache_key)
+                ):
+                    self._refresh_in_background(
+                        statement,
+                        sqlstatement,
+                        sqlstatement_timeout,
+                        cache_key,
+                        cache_time_sec,
+                        prepared,
+                    )
+                stats = {
+                    "status": "OK",
+                    "runtime": 0.0,
+                    "exception": None,
+                    "timeout": sqlstatement_timeout,
+                }
+                return (cached_data, mtime_cache_file, stats)
+
+        start_time = time.time()
+        try:
+            results, stats = self._query(
+                db,
+                statement,
+                sqlstatement,
+                query_timeout,
+                None if rendered_cache_key else cache_key,
+                cache_time_sec,
+                prepared,
+            )
+        except ConnectionBusy as e:
+            if flight is not None:
+                flight.release()
+            self.log.error(f"{statement} not run, {e}")
+            return self._skip_for_run_deadline(
+                statement, cache_key, sqlstatement_timeout, str(e)
+            )
+        except BaseException:
+            if flight is not None:
+                flight.release()
+            raise
+        if self.run_deadline is not None:
+            runtime = time.time() - start_time
+            if stats["status"] != "OK" and runtime >= query_timeout:
+                # Cut short, budget it for its full timeout next time
+                runtime = max(runtime, sqlstatement_timeout)
+            self.runtime_history.record(statement, runtime)
+        if (
+            prepared is not None
+            and prepared["interval_sec"] is not None
+            and stats["status"] == "OK"
+        ):
+            self.statement_schedule.record_run(statement, start_time)
+        if flight is not None:
+            if rendered_cache_key:
+                # Released once _output_prepared_statement has cached the section
+                prepared["single_flight"] = flight
+            else:
+                flight.release()
+        return (results, None, stats)
+
+    def _is_due(self, statement, prepared):
+        """Check whether a statement with interval_min has to run in this interval"""
+        return (
+            prepared is not None
+            and prepared["interval_sec"] is not None
+            and self.statement_schedule.is_due(
+                statement, prepared["state_statement_cfg"]
+            )
+        )
+
+    def _get_query_budget(self, statement, sqlstatement_timeout):
+        """
+        Check whether the rest of the run (see run_deadline) covers the expected
+        runtime of the statement.
+
+        Returns:
+            tuple: The timeout of the query, at most the rest of the run, and the
+            reason why the statement is not run or None.
+        """
+        remaining = self.run_deadline - time.time()
+        if remaining < self.min_query_budget_sec:
+            return sqlstatement_timeout, "run deadline reached"
+        expected_runtime = self.runtime_history.get(statement)
+        if expected_runtime is not None and expected_runtime > remaining:
+            return (
+                sqlstatement_timeout,
+                f"expected runtime {expected_runtime:.1f}s exceeds the "
+                f"{remaining:.1f}s left until the run deadline",
+            )
+        return min(sqlstatement_timeout, round(remaining, 1)), None
+
+    def _skip_for_run_deadline(self, statement, cache_key, sqlstatement_timeout, reason):
+        """
+        Serve the last cached result of a statement which is not run because of the
+        run deadline or a busy connection, also an expired one, else skip it. The
+        decision is recorded in the agent_db_stats entry as "deadline": "cache" or
+        "skipped".
+
+        Returns:
+            A tuple like _run_sql, the result is None if the statement is skipped.
+        """
+        stats = {
+            "status": "OK",
+            "runtime": 0.0,
+            "exception": None,
+            "timeout": sqlstatement_timeout,
+        }
+        if cache_key is not None:
+            cache_result = cache.get_cache(cache_key, self.cache_dir, None)
+            if cache_result is not None:
+                self.log.info(f"Serving cached result of {statement}, {reason}")
+                mtime_cache_file, cached_data = cache_result
+                stats["deadline"] = "cache"
+                return (cached_data, mtime_cache_file, stats)
+        self.log.info(f"Skipping {statement}, {reason}")
+        stats.update(
+            status="WARN",
+            runtime=None,
+            exception=f"Skipped, {reason}",
+            deadline="skipped",
+        )
+        return (None, None, stats)
+
+    def _get_cached_result(self, cache_key, cache_time_sec):
+        # The cache time is jittered per statement, see cache.get_jittered_time
+        return cache.get_cache(
+            cache_key,
+            self.cache_dir,
+            cache.get_jittered_time(cache_time_sec, cache_key),
+        )
+
+    def _query(
+        self,
+        db,
+        statement,
+        sqlstatement,
+        sqlstatement_timeout,
+        cache_key,
+        cache_time_sec,
+        prepared=None,
+    ):
+        """
+        Run the query in a thread, cancel it on timeout and write its result to the
+        cache if cache_key is given.
+
+        Rows of a prepared statement with stream_batch_rows are fetched in batches,
+        which are transformed and rendered right away, so only one batch is kept in
+        memory. The section is only written after the query has succeeded.
 
+        Returns:
+            A tuple containing the query results (a StreamedSection if streamed) and
+            the statement stats.
+        """
+        stats = {
+            "status": None,
+            "runtime": None,
+            "exception": None,
+            "timeout": sqlstatement_timeout,
+        }
+        results = []
+        stream_batch_rows = prepared.get("stream_batch_rows") if prepared else None
         # Define a function to run the query in a separate thread
-        def run_query():
+        def run_query(stop_event):
             nonlocal results, stats
+            cursor = None
+            query_results = []
+            locked = False
             try:
+                if query_lock is not None:
+                    while not query_lock.acquire(timeout=0.1):
+                        if stop_event.is_set():
+                            return
+                    locked = True
+                    if stop_event.is_set():
+                        # Given up while waiting for the lock
+                        return
+                started.set()
                 cursor = db.cursor()
                 start_time = time.time()  # Record start time
+                self.prepare_query(db, cursor, sqlstatement_timeout)
 
-                for result in self.query(cursor, sqlstatement):
-                    results.append(result)
+                if stream_batch_rows:
+                    query_results = self._stream_query(
+                        cursor, sqlstatement, prepared, stop_event
+                    )
+                else:
+                    for result in self.query(cursor, sqlstatement):
+                        if stop_event.is_set():
+                            return
+                        query_results.append(result)
 
                 end_time = time.time()  # Record end time
+                if stop_event.is_set():
+                    # The statement has already been reported as timed out
+                    return
+                results = query_results
                 stats["runtime"] = end_time - start_time  # Calculate runtime
                 stats["status"] = "OK"
-                if cache_time_sec is not None and cache_key is not None:
+                if cache_key is not None:
                     # Write the result to cache
                     self.log.debug(f"Writing cache for: {cache_key}")
-                    cache.write_cache(self.cache_dir, cache_key, results)
+                    self._write_cache(cache_key, results, cache_time_sec)
             except Exception as e:
+                self.reset_after_error(db)
+                if stop_event.is_set():
+                    self.log.debug(f"Cancelled query {statement} ended with: {e}")
+                    return
                 self.log.error(f"Error running query {statement}: {str(e)}")
                 stats["status"] = "CRIT"
                 stats["exception"] = str(e)
             finally:
-                cursor.close()
-
-        # Proceed with existing thread logic to execute query if not loaded from cache
+                if cursor is not None:
+                    try:
+                        cursor.close()
+                    except Exception:
+                        pass
+                if locked:
+                    query_lock.release()
+
+        check_termination()
+        # Proceed with existing thread logic to execute query if not loaded from cache.
+        # The thread is a daemon, so a query that cannot be cancelled does not keep
+        # the agent process alive.
+        query_lock = self.get_query_lock(db)
+        # Set once the query thread holds the connection
+        started = threading.Event()
         stop_event = threading.Event()
-        query_thread = threading.Thread(target=run_query)
+        query_thread = threading.Thread(
+            target=run_query, args=(stop_event,), daemon=True
+        )
         query_thread.start()
-        query_thread.join(timeout=sqlstatement_timeout)
-
+        if query_lock is not None:
+            # The connection may still be in use by a timed out statement, wait for
+            # it at most as long as for the query itself
+            wait_deadline = time.time() + sqlstatement_timeout
+            while (
+                not started.is_set()
+                and query_thread.is_alive()
+                and not _termination_requested.is_set()
+            ):
+                remaining = wait_deadline - time.time()
+                if remaining <= 0:
+                    break
+                started.wait(timeout=min(remaining, 0.1))
+            if (
+                not started.is_set()
+                and query_thread.is_alive()
+                and not _termination_requested.is_set()
+            ):
+                stop_event.set()
+                raise ConnectionBusy(
+                    f"connection still busy with a timed out statement after {sqlstatement_timeout}s"
+                )
+        # Wait for the query, but stop waiting as soon as termination is requested.
+        # The timeout starts once the query thread holds the connection.
+        deadline = time.time() + sqlstatement_timeout
+        while query_thread.is_alive() and not _termination_requested.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            query_thread.join(timeout=min(remaining, 0.1))
+
+        terminated = query_thread.is_alive() and _termination_requested.is_set()
         if query_thread.is_alive():
             stop_event.set()
-            self.log.error(f"Query {statement} took to long and has been terminated")
+            if terminated:
+                self.log.error(f"Query {statement} cancelled, agent_db has been terminated")
+            else:
+                self.log.error(f"Query {statement} took to long and has been terminated")
             stats["status"] = "CRIT"
             stats["exception"] = "Query took too long and has been terminated"
-
-        print("<<<agent_db_stats:sep(0)>>>")
-        stats = {self.db_cstr: {statement: stats}}
-        print(json.dumps(stats))
+            try:
+                self.cancel_query(db)
+            except Exception as e:
+                self.log.error(f"Error while cancelling query {statement}: {e}")
+            query_thread.join(timeout=self.cancel_grace_sec)
+            if query_thread.is_alive():
+                self.log.error(
+                    f"Query {statement} still running {self.cancel_grace_sec}s after cancellation"
+                )
+        if terminated:
+            check_termination()
 
         # self.connection.close()
-        return (results, mtime_cache_file)
+        return (results, stats)
+
+    def _stream_query(self, cursor, sqlstatement, prepared, stop_event):
+        """
+        Render the rows of the query batch by batch into a spool file.
+
+        Returns:
+            StreamedSection: The rendered section, None if stop_event has been set.
+        """
+        import tempfile
+
+        self.separator = prepared["separator"]
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=self.stream_spool_bytes,
+            mode="w+",
+            encoding="utf-8",
+            dir=self.omd_tmp,
+        )
+        batches = self.query(cursor, sqlstatement, prepared["stream_batch_rows"])
+        try:
+            for text in self.output_statement_result(
+                prepared["check_header"], prepared["check_header"], batches
+            ):
+                if stop_event.is_set():
+                    spool.close()
+                    return None
+                spool.write(text)
+        except BaseException:
+            spool.close()
+            raise
+        return StreamedSection(spool)
+
+    def _refresh_in_background(
+        self,
+        statement,
+        sqlstatement,
+        sqlstatement_timeout,
+        cache_key,
+        cache_time_sec,
+        prepared=None,
+    ):
+        """
+        Queue the refresh of a cached result (refresh_mode: background), while the
+        agent continues with the cached result. The refreshes of the run are started
+        together by _start_background_refresh. Not queued if another process is
+        refreshing the result already.
+        """
+        if cache_key in self._refresh_jobs:
+            return
+        flight = cache.SingleFlight(self.cache_dir, f"refresh_{cache_key}")
+        if not flight.acquire(0):
+            self.log.debug(f"{statement} is refreshed by another process already")
+            return
+        # Only probed, the refresh process takes the lock itself
+        flight.release()
+        self._refresh_jobs[cache_key] = {
+            "statement": statement,
+            "sqlstatement": sqlstatement,
+            "timeout": sqlstatement_timeout,
+            "cache_key": cache_key,
+            "cache_time_sec": cache_time_sec,
+            "prepared": prepared,
+        }
+
+    def _start_background_refresh(self):
+        """
+        Start one detached agent_db process refreshing the queued results of the run
+        on its own connection. A new process instead of a fork, so it inherits
+        neither the locks held by the threads of the agent nor its connections, see
+        refresh_cached_result.
+        """
+        if not self._refresh_jobs:
+            return
+        import subprocess
+
+        jobs = list(self._refresh_jobs.values())
+        self._refresh_jobs = {}
+        refresh = {
+            "backend": type(self).__module__,
+            "strategy_params": self.strategy_params,
+            "statement_timeout_sec": self.statement_timeout_sec,
+            "jobs": jobs,
+        }
+        try:
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; from cmk.special_agents.agent_db import main; sys.exit(main())",
+                    "refresh",
+                ],
+                stdin=subprocess.PIPE,
+                # Checkmk waits until the agent output is closed
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                # Not terminated together with the agent
+                start_new_session=True,
+            )
+            # The password is part of the parameters, so they are not passed on the
+            # command line
+            process.stdin.write(json.dumps(refresh).encode())
+            process.stdin.close()
+        except (OSError, TypeError, ValueError) as e:
+            self.log.error(
+                f"Could not start background refresh of "
+                f"{', '.join(job['statement'] for job in jobs)}: {e}"
+            )
+
+    def refresh_cached_result(self, job):
+        """
+        Run the statement of a background refresh and write its result to the cache.
+        Called by agent_db refresh for each job queued by _refresh_in_background, the
+        strategy has been created with its connection by then.
+        """
+        statement = job["statement"]
+        prepared = job["prepared"]
+        # Refreshed only once at a time, the lock file is removed on release
+        flight = cache.SingleFlight(self.cache_dir, f"refresh_{job['cache_key']}")
+        if not flight.acquire(0):
+            self.log.debug(f"{statement} is refreshed by another process already")
+            return
+        try:
+            self.log.debug(f"Refreshing {statement} in background")
+            rendered = prepared is not None and prepared["rendered_cache_key"]
+            results, stats = self._query(
+                self.connection,
+                statement,
+                job["sqlstatement"],
+                job["timeout"],
+                None if rendered else job["cache_key"],
+                job["cache_time_sec"],
+                prepared,
+            )
+            if rendered and stats["status"] == "OK":
+                self._write_cache(
+                    job["cache_key"],
+                    cache.RenderedSection(self._render_prepared(prepared, results)),
+                    job["cache_time_sec"],
+                )
+            self.log.debug(f"Background refresh of {statement}: {stats['status']}")
+        finally:
+            flight.release()
+
+    def prepare_query(self, db, cursor, timeout_sec):
+        """
+        Hook called in the query thread before a statement is executed, e.g. to set
+        a server side statement timeout. To be implemented in subclass.
+        """
+        pass
+
+    def get_query_lock(self, db):
+        """
+        Lock held by the query thread while a statement runs on the connection db,
+        None if not needed. For drivers which cannot cancel a statement from another
+        thread, so a timed out statement keeps the connection until it ends.
+        """
+        return None
+
+    def cancel_query(self, db):
+        """
+        Cancel the statement currently running on the connection db.
+        Called from the main thread when a statement exceeds its timeout_sec.
+        """
+        cancel = getattr(db, "cancel", None)
+        if cancel is not None:
+            cancel()
+
+    def reset_after_error(self, db):
+        """
+        Hook to bring the connection back into a usable state after a failed or
+        cancelled statement. To be implemented in subclass.
+        """
+        pass
 
 
 class PortChecker:
@@ -581,9 +1590,15 @@ class PortChecker:
         self.host = host
         self.port = port
         self.timeout = timeout
+        # Outcome of probe_ports
+        self.start = None
+        self.probe_time = None
+        self.error = None
 
     def is_port_open(self) -> bool:
         """Check if the specified TCP port is open."""
+        import socket
+
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(self.timeout)
 
@@ -592,3 +1607,71 @@ class PortChecker:
             return result == 0  # True if the port is open, otherwise False
         finally:
             sock.close()  # Ensure the socket is closed gracefully
+
+    def start_probe(self):
+        """
+        Start a non-blocking connect to the port, finished by probe_ports.
+
+        Returns:
+            socket.socket: The connecting socket or None if the connect failed already.
+        """
+        import socket
+
+        self.start = time.time()
+        try:
+            family, type_, proto, _name, address = socket.getaddrinfo(
+                self.host, self.port, type=socket.SOCK_STREAM
+            )[0]
+            sock = socket.socket(family, type_, proto)
+        except OSError as e:
+            self.finish_probe(str(e))
+            return None
+        sock.setblocking(False)
+        result = sock.connect_ex(address)
+        if result not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.finish_probe(os.strerror(result))
+            return None
+        return sock
+
+    def finish_probe(self, error=None):
+        self.probe_time = time.time() - self.start
+        self.error = error
+
+
+def probe_ports(checkers):
+    """
+    Probe the ports of all checkers concurrently with non-blocking connects.
+    Every checker gets its probe_time and error, which is None if the port is open.
+
+    Args:
+        checkers (list): PortChecker objects, probed for at most the longest timeout.
+    """
+    import selectors
+    import socket
+
+    selector = selectors.DefaultSelector()
+    for checker in checkers:
+        sock = checker.start_probe()
+        if sock is not None:
+            selector.register(sock, selectors.EVENT_WRITE, checker)
+
+    deadline = time.time() + max([checker.timeout for checker in checkers] or [0])
+    while selector.get_map():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        for key, _events in selector.select(remaining):
+            checker = key.data
+            # A finished connect is writable, SO_ERROR tells whether it succeeded
+            result = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            checker.finish_probe(os.strerror(result) if result else None)
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+
+    # Connects not finished before the deadline
+    for key in list(selector.get_map().values()):
+        key.data.finish_probe(f"timed out after {key.data.timeout} seconds")
+        selector.unregister(key.fileobj)
+        key.fileobj.close()
+    selector.close()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+import os
+import fcntl
+import hashlib
+import json
+import threading
+import time
+
+# Settings from the "circuit_breaker" section of agent_db.yml, see configure
+_breaker_settings = {
+    "enabled": False,
+    "failure_threshold": 2,
+    "backoff_sec": 60,
+    "max_backoff_sec": 900,
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of connecting while the circuit breaker of a database is open"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one database (db_host, port and connection string), shared by
+    all agent_db processes of the site through a state file.
+
+    After failure_threshold failed connection attempts in a row the breaker opens and
+    connections fail immediately. The open time starts at backoff_sec and doubles with
+    every further failure up to max_backoff_sec. Once it has passed, the breaker is
+    half-open: the next process probes the database while the others still fail
+    immediately. A successful connection closes the breaker again.
+    """
+
+    def __init__(
+        self,
+        state_dir,
+        db_host,
+        db_port,
+        db_cstr,
+        failure_threshold,
+        backoff_sec,
+        max_backoff_sec,
+    ):
+        self.state_dir = state_dir
+        # Connection strings may contain characters not allowed in file names
+        cstr_hash = hashlib.sha256(str(db_cstr).encode()).hexdigest()[:16]
+        self.state_file = os.path.join(state_dir, f"{db_host}_{db_port}_{cstr_hash}.json")
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+
+    def _backoff(self, failures):
+        exponent = max(0, failures - self.failure_threshold)
+        return min(self.max_backoff_sec, self.backoff_sec * 2**exponent)
+
+    def _update(self, update):
+        """Read, update and write the state while holding the lock of the state file"""
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir, exist_ok=True)
+        fd = os.open(f"{self.state_file}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                with open(self.state_file, "r") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {"failures": 0, "open_until": 0, "last_error": None}
+
+            result = update(state)
+
+            if state["failures"]:
+                tmp_file = f"{self.state_file}.{os.getpid()}.{threading.get_ident()}"
+                with open(tmp_file, "w") as f:
+                    json.dump(state, f)
+                os.replace(tmp_file, self.state_file)
+            elif os.path.exists(self.state_file):
+                os.remove(self.state_file)
+            return result
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def before_connect(self):
+        """
+        Check whether a connection may be attempted. In the half-open state the
+        caller becomes the probe, so other processes keep failing immediately
+        until its outcome is recorded.
+
+        Raises:
+            CircuitOpenError: If the breaker is open.
+        """
+
+        def check(state):
+            now = time.time()
+            if state["failures"] < self.failure_threshold:
+                return None
+            if now < state["open_until"]:
+                return (
+                    f"{state['failures']} connection attempts failed, next attempt in "
+                    f"{int(state['open_until'] - now) + 1}s. Last error: {state['last_error']}"
+                )
+            # Half-open, claim the probe for as long as the next backoff would be
+            state["open_until"] = now + self._backoff(state["failures"])
+            return None
+
+        error = self._update(check)
+        if error is not None:
+            raise CircuitOpenError(error)
+
+    def is_open(self):
+        """
+        Check whether the breaker is open, without claiming the probe of the
+        half-open state like before_connect.
+
+        Returns:
+            bool: True while connection attempts fail immediately.
+        """
+        try:
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (
+            state["failures"] >= self.failure_threshold
+            and time.time() < state["open_until"]
+        )
+
+    def record_success(self):
+        """
+        Close the breaker after a successful connection.
+
+        Returns:
+            bool: True if connection attempts had failed before.
+        """
+
+        def reset(state):
+            failed = state["failures"] > 0
+            state["failures"] = 0
+            return failed
+
+        return self._update(reset)
+
+    def record_failure(self, error):
+        """Count a failed connection attempt, which opens the breaker at failure_threshold"""
+
+        def fail(state):
+            state["failures"] += 1
+            state["last_error"] = str(error).splitlines()[0] if str(error) else None
+            if state["failures"] >= self.failure_threshold:
+                state["open_until"] = time.time() + self._backoff(state["failures"])
+
+        self._update(fail)
+
+
+def configure(settings):
+    """
+    Apply the "circuit_breaker" section of agent_db.yml, e.g.
+    {"enabled": True, "failure_threshold": 2, "backoff_sec": 60}.
+    """
+    _breaker_settings.update(settings or {})
+
+
+def get_circuit_breaker(state_dir, db_host, db_port, db_cstr):
+    """Return the CircuitBreaker of the database or None if it is disabled"""
+    if not _breaker_settings.get("enabled"):
+        return None
+    return CircuitBreaker(
+        state_dir,
+        db_host,
+        db_port,
+        db_cstr,
+        _breaker_settings["failure_threshold"],
+        _breaker_settings["backoff_sec"],
+        _breaker_settings["max_backoff_sec"],
+    )
@@ -6,67 +6,612 @@
 # This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
 
 import os
+import sys
+import atexit
+import fcntl
 import hashlib
 import pickle
+import threading
 import time
 
+# Settings of the "cache" section of agent_db.yml, see configure
+_cache_settings = {
+    "backend": "sqlite",
+    "max_size_mb": 256,
+    "ttl_jitter": 0.1,
+    "warmup": False,
+    "single_flight": True,
+    "keep_expired_min": 0,
+}
+# One cache backend per cache directory, shared by all strategies of the process
+_cache_backends = {}
+_cache_backends_lock = threading.Lock()
 
-def generate_cache_key(db_host, db_cstr, statement):
+
+class CacheWriteError(Exception):
+    """Raised by write_cache and delete_cache if the cache backend fails, e.g. when the database is locked"""
+
+
+def generate_cache_key(db_host, db_cstr, statement, sqlstatement=None, db_version=None):
     """
     Generates a unique cache key for storing SQL query results.
 
     Parameters:
     - db_cstr (str): Database connection string, used to differentiate caches across different databases.
     - statement (str): The SQL statement for which the cache key is being generated.
+    - sqlstatement (str): The SQL text of the statement (optional).
+    - db_version (str): The version of the database (optional).
 
     Returns:
-    - str: A SHA256 hash digest of the database connection string and SQL statement, serving as a unique cache key.
+    - str: The cache key. With sqlstatement, it ends with a hash of the SQL text and the
+      database version, so changed statement files and version variants never hit old entries.
     """
-    # sqlstatement = hashlib.sha256((sqlstatement).encode()).hexdigest()
     if db_cstr.startswith("("):
         db_cstr = f"dsn_{hashlib.sha256(db_cstr.encode()).hexdigest()}"
     cache_key = f"{db_host}_{db_cstr}_{statement}"
+    if sqlstatement is not None:
+        content_hash = hashlib.sha256(
+            f"{db_version}\0{sqlstatement}".encode()
+        ).hexdigest()[:16]
+        cache_key += f"_{content_hash}"
     return cache_key
 
 
+def jitter_factor(cache_key, salt=""):
+    """
+    Deterministic number in [0, 1) for a cache key, the same in every process,
+    so the cache entries of different hosts and statements are spread over time.
+    """
+    digest = hashlib.sha256(f"{salt}{cache_key}".encode()).hexdigest()
+    return int(digest[:8], 16) / 0x100000000
+
+
+def get_jittered_time(seconds, cache_key):
+    """
+    Shorten a cache or refresh time by up to the ttl_jitter share, deterministically
+    per cache key (host, cstr and statement). Results are never served longer than
+    configured, but hosts sharing the same cache_time_min no longer expire together.
+
+    Parameters:
+    - seconds (float): The configured time, may be None.
+    - cache_key (str): The cache key of the statement.
+
+    Returns:
+    - float or None: The jittered time.
+    """
+    if seconds is None or not _cache_settings.get("ttl_jitter"):
+        return seconds
+    return seconds * (1 - _cache_settings["ttl_jitter"] * jitter_factor(cache_key))
+
+
+def generate_rendered_cache_key(cache_key, backend, check_header, separator):
+    """
+    Generates the cache key of a rendered section. Rendered sections depend on the
+    strategy, the section header and the separator besides the statement.
+
+    Parameters:
+    - cache_key (str): Cache key of the statement, see generate_cache_key.
+    - backend (str): Backend of the strategy rendering the section.
+    - check_header (str): Header of the section.
+    - separator (str): Separator of the section.
+
+    Returns:
+    - str: The cache key of the rendered section.
+    """
+    variant = hashlib.sha256(
+        f"{backend}\0{check_header}\0{separator}".encode()
+    ).hexdigest()[:16]
+    return f"{cache_key}_rendered_{variant}"
+
+
+def is_single_flight_enabled():
+    return bool(_cache_settings.get("single_flight"))
+
+
+class SingleFlight:
+    """
+    Lock of a cache key shared by all agent_db processes of the site, held while
+    the query of a cache miss runs. Processes missing the same key meanwhile wait
+    for the lock and then read the result from the cache.
+
+    The holder removes the lock file on release, so there is no file per cache key
+    left behind. A waiter that has locked a removed file locks the new one instead.
+    """
+
+    poll_interval_sec = 0.05
+
+    def __init__(self, cache_dir, cache_key):
+        self.lock_dir = os.path.join(cache_dir, "locks")
+        self.lock_file = os.path.join(
+            self.lock_dir, f"{hashlib.sha256(cache_key.encode()).hexdigest()[:32]}.lock"
+        )
+        self.fd = None
+        self.locked = False
+        self.waited = False
+
+    def _is_current(self):
+        """Check whether the locked file is still the lock file of the key"""
+        try:
+            current = os.stat(self.lock_file)
+        except FileNotFoundError:
+            return False
+        locked = os.fstat(self.fd)
+        return (current.st_dev, current.st_ino) == (locked.st_dev, locked.st_ino)
+
+    def acquire(self, wait_sec):
+        """
+        Acquire the lock, waiting at most wait_sec seconds for another holder.
+        waited is set if the lock was held by another process.
+
+        Returns:
+        - bool: True if the lock has been acquired.
+        """
+        if not os.path.exists(self.lock_dir):
+            os.makedirs(self.lock_dir, exist_ok=True)
+        deadline = time.time() + wait_sec
+        while True:
+            if self.fd is None:
+                self.fd = os.open(self.lock_file, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if self._is_current():
+                    self.locked = True
+                    return True
+                # Removed by the previous holder meanwhile
+                os.close(self.fd)
+                self.fd = None
+                continue
+            except BlockingIOError:
+                pass
+            self.waited = True
+            if time.time() >= deadline:
+                self.release()
+                return False
+            time.sleep(self.poll_interval_sec)
+
+    def release(self):
+        if self.fd is not None:
+            if self.locked:
+                try:
+                    os.remove(self.lock_file)
+                except FileNotFoundError:
+                    pass
+                self.locked = False
+            # Closing the file releases the lock
+            os.close(self.fd)
+            self.fd = None
+
+
+def purge_lock_files(cache_dir):
+    """
+    Remove the SingleFlight lock files not held by any process, e.g. left behind by
+    a killed agent. Returns the number of removed files.
+    """
+    lock_dir = os.path.join(cache_dir, "locks")
+    if not os.path.exists(lock_dir):
+        return 0
+    removed = 0
+    for filename in os.listdir(lock_dir):
+        lock_file = os.path.join(lock_dir, filename)
+        try:
+            fd = os.open(lock_file, os.O_RDWR)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Locked like a holder, see SingleFlight.release
+            os.remove(lock_file)
+            removed += 1
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        finally:
+            os.close(fd)
+    return removed
+
+
+class RenderedSection:
+    """Cached section content, written without rendering the rows again"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class CacheBackend:
+    """
+    Interface of the result cache backends.
+
+    Entries are (mtime, data) pairs. mtime is the integer timestamp of the write,
+    which is reported in the cached(mtime,ttl) section header.
+    """
+
+    def get(self, cache_key, max_cache_age_sec):
+        """
+        Return (mtime, data) if the entry is younger than max_cache_age_sec, else None.
+        With max_cache_age_sec None, any entry which has not been evicted yet is
+        returned, also an expired one.
+        """
+        raise NotImplementedError()
+
+    def put(self, cache_key, data, cache_time_sec=None):
+        """Store data. The entry may be evicted after cache_time_sec seconds."""
+        raise NotImplementedError()
+
+    def delete(self, cache_key):
+        raise NotImplementedError()
+
+    def evict(self):
+        """Remove expired entries and enforce the size limit"""
+        pass
+
+    def stats(self):
+        """Return the hit and miss counters and the number and size of the entries"""
+        return {}
+
+    def entries(self, prefix=""):
+        """Return (cache_key, mtime, expires, size) of all entries starting with prefix"""
+        raise NotImplementedError()
+
+    def purge(self, prefix=""):
+        """Remove all entries starting with prefix, return the number of removed entries"""
+        raise NotImplementedError()
+
+    def flush_counters(self):
+        pass
+
+
+class PickleFileCache(CacheBackend):
+    """One pickle file per cache entry, the format used up to now"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _cache_file(self, cache_key):
+        return os.path.join(self.cache_dir, cache_key + ".pkl")
+
+    def get(self, cache_key, max_cache_age_sec):
+        cache_file = self._cache_file(cache_key)
+        try:
+            mtime_cache_file = int(os.path.getmtime(cache_file))
+            if (
+                max_cache_age_sec is None
+                or time.time() - mtime_cache_file < max_cache_age_sec
+            ):
+                with open(cache_file, "rb") as f:
+                    return (mtime_cache_file, pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        return None
+
+    def put(self, cache_key, data, cache_time_sec=None):
+        cache_file = self._cache_file(cache_key)
+        # Write to a temporary file first, so concurrent agents never read a partial file
+        tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+
+    def delete(self, cache_key):
+        try:
+            os.remove(self._cache_file(cache_key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "size_bytes": sum(entry[3] for entry in entries),
+        }
+
+    def entries(self, prefix=""):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith(prefix) and entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                entries.append((entry.name[:-4], int(stat.st_mtime), None, stat.st_size))
+        return sorted(entries)
+
+    def purge(self, prefix=""):
+        entries = self.entries(prefix)
+        for cache_key, _mtime, _expires, _size in entries:
+            self.delete(cache_key)
+        return len(entries)
+
+
+class SQLiteCache(CacheBackend):
+    """
+    All cache entries of the site in one indexed SQLite database.
+
+    Writes are atomic transactions, so readers never see partial entries. Entries
+    are evicted once their cache time has passed and, oldest first, when the
+    database exceeds max_size_bytes. Hit and miss counters are accumulated in the
+    process and added to the database when the process ends.
+    """
+
+    # Seconds between two evictions of one process
+    evict_interval_sec = 60
+    # Counter updates after which the counters are written to the database
+    counter_flush_threshold = 100
+
+    def __init__(self, db_file, max_size_bytes=None):
+        self.db_file = db_file
+        self.max_size_bytes = max_size_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+        self._last_evict = 0.0
+        with self._connection() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY,"
+                " mtime INTEGER NOT NULL,"
+                " expires INTEGER,"
+                " size INTEGER NOT NULL,"
+                " data BLOB NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_mtime ON cache (mtime)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                " name TEXT PRIMARY KEY,"
+                " value INTEGER NOT NULL)"
+            )
+            # Keys which have had an entry, not cleaned by evict, see warmup in put
+            if not db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'warmed_keys'"
+            ).fetchone():
+                db.execute("CREATE TABLE warmed_keys (key TEXT PRIMARY KEY)")
+                db.execute("INSERT INTO warmed_keys (key) SELECT key FROM cache")
+        atexit.register(self.flush_counters)
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            import sqlite3
+
+            db = sqlite3.connect(self.db_file, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+            pending = sum(self._counters.values())
+        if pending >= self.counter_flush_threshold:
+            self.flush_counters()
+
+    def flush_counters(self):
+        with self._lock:
+            counters = self._counters
+            self._counters = {"hits": 0, "misses": 0}
+        try:
+            with self._connection() as db:
+                for name, value in counters.items():
+                    if value:
+                        db.execute(
+                            "INSERT INTO counters (name, value) VALUES (?, ?)"
+                            " ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                            (name, value),
+                        )
+        except _sqlite_errors():
+            pass
+
+    def get(self, cache_key, max_cache_age_sec):
+        try:
+            if max_cache_age_sec is None:
+                row = (
+                    self._connection()
+                    .execute("SELECT mtime, data FROM cache WHERE key = ?", (cache_key,))
+                    .fetchone()
+                )
+            else:
+                row = (
+                    self._connection()
+                    .execute(
+                        "SELECT mtime, data FROM cache WHERE key = ? AND mtime > ?"
+                        " AND (expires IS NULL OR expires > ?)",
+                        (cache_key, time.time() - max_cache_age_sec, time.time()),
+                    )
+                    .fetchone()
+                )
+            if row is not None:
+                result = (row[0], pickle.loads(row[1]))
+                self._count("hits")
+                return result
+        except _sqlite_errors() + (EOFError, pickle.UnpicklingError):
+            pass
+        self._count("misses")
+        return None
+
+    def put(self, cache_key, data, cache_time_sec=None):
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        mtime = int(time.time())
+        expires = mtime + cache_time_sec if cache_time_sec is not None else None
+        with self._connection() as db:
+            if (
+                expires is not None
+                and _cache_settings.get("warmup")
+                and db.execute(
+                    "INSERT OR IGNORE INTO warmed_keys (key) VALUES (?)", (cache_key,)
+                ).rowcount
+                == 1
+            ):
+                # First entry of the key (e.g. new site or host): it expires after a
+                # share of the cache time, spreading the refreshes of all new keys
+                # over the first cache period.
+                expires = mtime + max(
+                    1, int(cache_time_sec * jitter_factor(cache_key, "warmup"))
+                )
+            db.execute(
+                "INSERT OR REPLACE INTO cache (key, mtime, expires, size, data)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (cache_key, mtime, expires, len(blob), blob),
+            )
+        if time.time() - self._last_evict > self.evict_interval_sec:
+            self.evict()
+
+    def delete(self, cache_key):
+        with self._connection() as db:
+            db.execute("DELETE FROM cache WHERE key = ?", (cache_key,))
+
+    def evict(self):
+        self._last_evict = time.time()
+        with self._connection() as db:
+            # Expired entries may still be served, e.g. when the run deadline is reached
+            keep_expired_sec = _cache_settings.get("keep_expired_min", 0) * 60
+            db.execute(
+                "DELETE FROM cache WHERE expires < ?",
+                (int(time.time() - keep_expired_sec),),
+            )
+            if self.max_size_bytes is None:
+                return
+            (size,) = db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()
+            if size <= self.max_size_bytes:
+                return
+            # Remove the oldest entries until the limit is kept
+            for key, entry_size in db.execute(
+                "SELECT key, size FROM cache ORDER BY mtime"
+            ).fetchall():
+                db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                size -= entry_size
+                if size <= self.max_size_bytes:
+                    break
+
+    def stats(self):
+        self.flush_counters()
+        db = self._connection()
+        entries, size = db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()
+        stats = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        stats.update({"entries": entries, "size_bytes": size})
+        return stats
+
+    @staticmethod
+    def _like_prefix(prefix):
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return f"{escaped}%"
+
+    def entries(self, prefix=""):
+        return self._connection().execute(
+            "SELECT key, mtime, expires, size FROM cache"
+            " WHERE key LIKE ? ESCAPE '\\' ORDER BY key",
+            (self._like_prefix(prefix),),
+        ).fetchall()
+
+    def purge(self, prefix=""):
+        with self._connection() as db:
+            db.execute(
+                "DELETE FROM warmed_keys WHERE key LIKE ? ESCAPE '\\'",
+                (self._like_prefix(prefix),),
+            )
+            return db.execute(
+                "DELETE FROM cache WHERE key LIKE ? ESCAPE '\\'",
+                (self._like_prefix(prefix),),
+            ).rowcount
+
+
+def configure(settings):
+    """
+    Apply the "cache" section of agent_db.yml, e.g.
+    {"backend": "sqlite", "max_size_mb": 256}. Backends already in use keep
+    their settings.
+    """
+    _cache_settings.update(settings or {})
+
+
+def get_cache_backend(cache_dir):
+    """Return the cache backend of the cache directory"""
+    with _cache_backends_lock:
+        backend = _cache_backends.get(cache_dir)
+        if backend is None:
+            if _cache_settings["backend"] == "pickle":
+                backend = PickleFileCache(cache_dir)
+            elif _cache_settings["backend"] == "sqlite":
+                max_size_mb = _cache_settings.get("max_size_mb")
+                backend = SQLiteCache(
+                    os.path.join(cache_dir, "cache.sqlite"),
+                    max_size_mb * 1024 * 1024 if max_size_mb else None,
+                )
+            else:
+                raise ValueError(
+                    f"Unknown cache backend: {_cache_settings['backend']}"
+                )
+            _cache_backends[cache_dir] = backend
+        return backend
+
+
+def _sqlite_errors():
+    """
+    Errors of the sqlite backend to handle. sqlite3 is imported by the sqlite backend
+    only, as long as it is not imported there are none.
+    """
+    sqlite3 = sys.modules.get("sqlite3")
+    return (sqlite3.Error,) if sqlite3 is not None else ()
+
+
 def get_cache(cache_key, cache_dir, max_cache_age_sec):
     """
     Checks if there is a valid cache entry for the given cache key and that it is within the specified age limit.
 
     Parameters:
     - cache_key (str): The cache key to look up in the cache directory.
-    - max_age_seconds (int): The maximum age in seconds for the cache to be considered valid.
+    - max_age_seconds (int): The maximum age in seconds for the cache to be considered valid,
+      None for any entry not evicted yet, also an expired one.
 
     Returns:
     - tuple: A tuple containing the modification time of the cache file and the cached data if a valid cache is found and is within the age limit.
     - None: If the cache does not exist or is older than the specified maximum age.
     """
+    try:
+        backend = get_cache_backend(cache_dir)
+    except _sqlite_errors():
+        # Like a cache miss, e.g. if the database is locked while it is created
+        return None
+    return backend.get(cache_key, max_cache_age_sec)
 
-    cache_file = os.path.join(cache_dir, cache_key + ".pkl")
-
-    if os.path.exists(cache_file):
-        mtime_cache_file = int(os.path.getmtime(cache_file))
-        cache_age = time.time() - mtime_cache_file
-        if cache_age < max_cache_age_sec:
-            with open(cache_file, "rb") as f:
-                return (mtime_cache_file, pickle.load(f))
-    return None
 
-
-def write_cache(cache_dir, cache_key, data):
+def write_cache(cache_dir, cache_key, data, cache_time_sec=None):
     """
     Writes the provided data to a cache file identified by the cache key.
 
     Parameters:
     - cache_key (str): The cache key under which the data should be stored.
     - data: The data to be cached. This can be any object that can be serialized by pickle.
+    - cache_time_sec (int): Seconds after which the entry may be evicted, None to keep it.
 
     Returns:
     - None
+
+    Raises:
+    - CacheWriteError: If the entry could not be written.
     """
-    cache_file = os.path.join(cache_dir, cache_key + ".pkl")
-    with open(cache_file, "wb") as f:
-        pickle.dump(data, f)
+    try:
+        get_cache_backend(cache_dir).put(cache_key, data, cache_time_sec)
+    except _sqlite_errors() + (OSError, pickle.PicklingError) as e:
+        raise CacheWriteError(f"Could not write cache entry {cache_key}: {e}") from e
+
+
+def delete_cache(cache_dir, cache_key):
+    """
+    Removes the cache file identified by the cache key, if there is one.
+
+    Parameters:
+    - cache_key (str): The cache key of the data to be removed.
+
+    Returns:
+    - None
+
+    Raises:
+    - CacheWriteError: If the entry could not be removed.
+    """
+    try:
+        get_cache_backend(cache_dir).delete(cache_key)
+    except _sqlite_errors() + (OSError,) as e:
+        raise CacheWriteError(f"Could not remove cache entry {cache_key}: {e}") from e
 
 
 def get_cache_time_in_seconds(state_statement_cfg):
@@ -81,3 +626,21 @@ def get_cache_time_in_seconds(state_statement_cfg):
     """
     cache_time_min = state_statement_cfg.get("cache_time_min")
     return cache_time_min * 60 if cache_time_min is not None else None
+
+
+def get_refresh_time_in_seconds(state_statement_cfg):
+    """
+    Age in seconds after which a cached result is refreshed in the background,
+    a share (refresh_after, default 0.8) of the cache time. Only statements with
+    refresh_mode background and a cache time are refreshed in the background.
+
+    Args:
+        state_statement_cfg (dict): Configuration of the current statement.
+
+    Returns:
+        float or None: Refresh time in seconds, or None for inline refreshes.
+    """
+    cache_time_sec = get_cache_time_in_seconds(state_statement_cfg)
+    if cache_time_sec is None or state_statement_cfg.get("refresh_mode") != "background":
+        return None
+    return cache_time_sec * state_statement_cfg.get("refresh_after", 0.8)
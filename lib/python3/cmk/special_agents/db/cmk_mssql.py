@@ -7,15 +7,22 @@
 
 import pymssql
 import sys
+import math
 import time
 from datetime import datetime, timezone
 import inspect
+import threading
 from cmk.special_agents.db import basedb
+from cmk.special_agents.db import breaker
 
 
 class DBStrategy(basedb.BaseDBStrategy):
     """MSSQL DB Strategy Implementation"""
 
+    # Their transformation combines lines of different result sets or checks the
+    # complete result, see transform_subresult and transform_result
+    unstreamable_statements = ("mssql_tablespaces", "mssql_blocked_sessions")
+
     def __init__(
         self,
         db_host,
@@ -27,6 +34,8 @@ class DBStrategy(basedb.BaseDBStrategy):
         db_instance,
         db_cursor_timeout_sec,
         loglevel,
+        output=None,
+        probe_time=None,
     ):
         super().__init__(
             db_host,
@@ -38,6 +47,8 @@ class DBStrategy(basedb.BaseDBStrategy):
             db_instance,
             db_cursor_timeout_sec,
             loglevel,
+            output,
+            probe_time,
         )
         # Get the name of the current strategy module
         current_module = inspect.getmodule(inspect.currentframe())
@@ -51,43 +62,29 @@ class DBStrategy(basedb.BaseDBStrategy):
             f"{self.omd_root}/local/share/check_mk/agents/db/{self.backend}/sql"
         )
 
+        self.db_user = db_user
+        self.db_pass = db_pass
+        self.db_instance = db_instance
+        # Lock per connection, see get_query_lock
+        self._query_locks = {}
+
         error_message = None
         connection_time = None
         self.is_first_mssql_counters_section = True
         self.mssql_tablespaces_first_line = None
         try:
             start_connect = time.time()  # Record start time
-            if db_instance:
-                # server_cstr = f"{db_host}\{db_instance}"
-                server_cstr = f"{db_host}:{db_port}\{db_instance}"
-                self.log.debug(
-                    f"Instance connect to host {server_cstr} to db {db_cstr}"
-                )
-                self.connection = pymssql.connect(
-                    user=db_user,
-                    password=db_pass,
-                    server=server_cstr,
-                    database=db_cstr,
-                    login_timeout=db_cursor_timeout_sec,
-                )
-            else:
-                self.log.debug(
-                    f"Standard connect to host {db_host} on port {db_port} to db {db_cstr}"
-                )
-                self.connection = pymssql.connect(
-                    user=db_user,
-                    password=db_pass,
-                    server=db_host,
-                    port=db_port,
-                    database=db_cstr,
-                    login_timeout=db_cursor_timeout_sec,
-                )
+            self.connection = self.open_guarded_connection()
 
         except pymssql.Error as e:
             if "timed out" in str(e).lower():
                 error_message = self.format_error_message(db_cstr, e, timeout=True)
             else:
                 error_message = self.format_error_message(db_cstr, e)
+        except breaker.CircuitOpenError as e:
+            error_message = self.FormattedErrorMessage(
+                f"Connection to {self.backend_service_prefix} DB '{db_cstr}' skipped, {e}"
+            )
 
         if error_message:
             self.log.error(error_message)
@@ -103,6 +100,65 @@ class DBStrategy(basedb.BaseDBStrategy):
             )  # Calculate connection time
             self.print_backend_connection_time(self.backend, db_cstr, connection_time)
 
+    def open_connection(self):
+        connection = self._connect()
+        # Keyed by id, the connection is kept so its id is not reused meanwhile
+        self._query_locks[id(connection)] = (connection, threading.Lock())
+        return connection
+
+    def _connect(self):
+        # FreeTDS applies the statement timeout to all connections of the process,
+        # so all connections use the same one, the longest statement timeout. Shorter
+        # statement timeouts are enforced by the agent, see BaseDBStrategy._query.
+        timeout = math.ceil(self.statement_timeout_sec or 0)
+        if self.db_instance:
+            # server_cstr = f"{db_host}\{db_instance}"
+            server_cstr = f"{self.db_host}:{self.db_port}\{self.db_instance}"
+            self.log.debug(
+                f"Instance connect to host {server_cstr} to db {self.db_cstr}"
+            )
+            return pymssql.connect(
+                user=self.db_user,
+                password=self.db_pass,
+                server=server_cstr,
+                database=self.db_cstr,
+                login_timeout=self.db_cursor_timeout_sec,
+                timeout=timeout,
+            )
+        self.log.debug(
+            f"Standard connect to host {self.db_host} on port {self.db_port} to db {self.db_cstr}"
+        )
+        return pymssql.connect(
+            user=self.db_user,
+            password=self.db_pass,
+            server=self.db_host,
+            port=self.db_port,
+            database=self.db_cstr,
+            login_timeout=self.db_cursor_timeout_sec,
+            timeout=timeout,
+        )
+
+    def reuse_connection(self, output=None):
+        # Reset the state kept between the statements of one run
+        self.is_first_mssql_counters_section = True
+        self.mssql_tablespaces_first_line = None
+        return super().reuse_connection(output)
+
+    def get_query_lock(self, db):
+        # A timed out statement runs until FreeTDS cancels it with the timeout of the
+        # connection, the next statement on the connection waits for it
+        entry = self._query_locks.get(id(db))
+        if entry is None or entry[0] is not db:
+            entry = (db, threading.Lock())
+            self._query_locks[id(db)] = entry
+        return entry[1]
+
+    def cancel_query(self, db):
+        # On its timeout FreeTDS sends an attention to the server, which cancels the
+        # running batch but keeps the session usable for the next statements.
+        # Calling dbcancel from another thread is not safe with FreeTDS.
+        pass
+
     def list_all_dbs(self):
         list_dbs_query = "SELECT name FROM sys.databases"
         self.cursor.execute(list_dbs_query)
@@ -219,15 +275,14 @@ class DBStrategy(basedb.BaseDBStrategy):
             # Leave output as it is
             return subresult
         else:
-            sql_output_string = ""
-            for line in subresult:
-                sql_output_string += (
-                    self.separator_char.join([str(val).strip() for val in line]) + "\n"
-                )
-            return sql_output_string
+            separator = self.separator_char
+            return "".join(
+                separator.join([str(val).strip() for val in line]) + "\n"
+                for line in subresult
+            )
 
     @staticmethod
-    def query(cursor, sqlstatement):
+    def query(cursor, sqlstatement, batch_size=None):
         if sqlstatement.startswith("BEGIN") or sqlstatement.startswith("DECLARE"):
             sqls = [sqlstatement]
         else:
@@ -236,7 +291,6 @@ class DBStrategy(basedb.BaseDBStrategy):
         for sql in sqls:
             cursor.execute(sql)
             while True:
-                ret = cursor.fetchall()
-                yield ret
+                yield from basedb.fetch_result_set(cursor, batch_size)
                 if not cursor.nextset():
                     break
@@ -10,6 +10,7 @@ import sys
 import time
 import inspect
 from cmk.special_agents.db import basedb
+from cmk.special_agents.db import breaker
 
 
 class DBStrategy(basedb.BaseDBStrategy):
@@ -26,6 +27,8 @@ class DBStrategy(basedb.BaseDBStrategy):
         db_instance,
         db_cursor_timeout_sec,
         loglevel,
+        output=None,
+        probe_time=None,
     ):
         super().__init__(
             db_host,
@@ -37,6 +40,8 @@ class DBStrategy(basedb.BaseDBStrategy):
             db_instance,
             db_cursor_timeout_sec,
             loglevel,
+            output,
+            probe_time,
         )
         # Get the name of the current strategy module
         current_module = inspect.getmodule(inspect.currentframe())
@@ -51,23 +56,25 @@ class DBStrategy(basedb.BaseDBStrategy):
             f"{self.omd_root}/local/share/check_mk/agents/db/{self.backend}/sql"
         )
 
+        self.db_user = db_user
+        self.db_pass = db_pass
+        # Session variable for a server side statement timeout, detected on first use
+        self.timeout_variable = None
+
         error_message = None
         connection_time = None
         try:
             start_connect = time.time()  # Record start time
-            self.connection = pymysql.connect(
-                user=db_user,
-                password=db_pass,
-                host=db_host,
-                port=db_port,
-                database=db_cstr,
-                connect_timeout=db_cursor_timeout_sec,
-            )
+            self.connection = self.open_guarded_connection()
         except pymysql.Error as e:
             if "timed out" in str(e).lower():
                 error_message = self.format_error_message(db_cstr, e, timeout=True)
             else:
                 error_message = self.format_error_message(db_cstr, e)
+        except breaker.CircuitOpenError as e:
+            error_message = self.FormattedErrorMessage(
+                f"Connection to {self.backend_service_prefix} DB '{db_cstr}' skipped, {e}"
+            )
 
         if error_message:
             self.log.error(error_message)
@@ -83,6 +90,61 @@ class DBStrategy(basedb.BaseDBStrategy):
             )  # Calculate connection time
             self.print_backend_connection_time(self.backend, db_cstr, connection_time)
 
+    def open_connection(self):
+        return pymysql.connect(
+            user=self.db_user,
+            password=self.db_pass,
+            host=self.db_host,
+            port=self.db_port,
+            database=self.db_cstr,
+            connect_timeout=self.db_cursor_timeout_sec,
+        )
+
+    def prepare_query(self, db, cursor, timeout_sec):
+        # MySQL limits SELECT statements via max_execution_time (ms),
+        # MariaDB all statements via max_statement_time (s)
+        variables = [
+            ("max_execution_time", int(timeout_sec * 1000)),
+            ("max_statement_time", timeout_sec),
+        ]
+        for variable, value in variables:
+            if self.timeout_variable not in (None, variable):
+                continue
+            try:
+                cursor.execute(f"SET SESSION {variable} = %s", (value,))
+                self.timeout_variable = variable
+                return
+            except pymysql.Error as e:
+                self.log.debug(f"Could not set {variable}: {e}")
+        self.timeout_variable = False
+
+    def cancel_query(self, db):
+        if self.timeout_variable:
+            # The server cancels the statement itself, see prepare_query
+            self.log.debug(f"Statement cancelled by the server via {self.timeout_variable}")
+            return
+        # KILL QUERY has to be sent via a separate connection, which takes a session
+        # like the other connections and is not opened while the breaker is open
+        if self.circuit_breaker is not None and self.circuit_breaker.is_open():
+            self.log.error("Statement not cancelled, circuit breaker is open")
+            return
+        slot = None
+        if self.session_limiter is not None:
+            slot = self.session_limiter.acquire()
+            if slot is None:
+                self.log.error("Statement not cancelled, session limit reached")
+                return
+        try:
+            killer = self.open_connection()
+            try:
+                with killer.cursor() as cursor:
+                    cursor.execute("KILL QUERY %s", (db.thread_id(),))
+            finally:
+                killer.close()
+        finally:
+            if slot is not None:
+                slot.release()
+
     def get_version(self):
         # get version from mysql
         statement = "SELECT version()"
@@ -100,9 +162,6 @@ class DBStrategy(basedb.BaseDBStrategy):
             # Leave output as it is
             return subresult
         else:
-            subresult_string = ""
-            for line in subresult:
-                for val in line:
-                    subresult_string += str(val) + " "
-                subresult_string += "\n"
-            return subresult_string
+            return "".join(
+                "".join(str(val) + " " for val in line) + "\n" for line in subresult
+            )
@@ -10,12 +10,19 @@ import sys
 import time
 import re
 import inspect
+import threading
 from cmk.special_agents.db import basedb
+from cmk.special_agents.db import breaker
+
+# init_oracle_client may be called from several DBHandler workers at once
+_oracle_client_lock = threading.Lock()
 
 
 class DBStrategy(basedb.BaseDBStrategy):
     """Oracle DB Strategy Implementation"""
 
+    ping_statement = "SELECT 1 FROM dual"
+
     def __init__(
         self,
         db_host,
@@ -27,6 +34,8 @@ class DBStrategy(basedb.BaseDBStrategy):
         db_instance,
         db_cursor_timeout_sec,
         loglevel,
+        output=None,
+        probe_time=None,
     ):
         super().__init__(
             db_host,
@@ -38,6 +47,8 @@ class DBStrategy(basedb.BaseDBStrategy):
             db_instance,
             db_cursor_timeout_sec,
             loglevel,
+            output,
+            probe_time,
         )
         self.db_host = db_host
         self.db_user = db_user
@@ -67,7 +78,8 @@ class DBStrategy(basedb.BaseDBStrategy):
 
     def _initialize_oracle_client(self):
         """Enable thick mode to prevent PY-4011 error"""
-        oracledb.init_oracle_client()
+        with _oracle_client_lock:
+            oracledb.init_oracle_client()
 
     def _check_oracle_port(self):
         """Check if the Oracle DB port is reachable."""
@@ -85,24 +97,18 @@ class DBStrategy(basedb.BaseDBStrategy):
         """Establish a connection to the Oracle DB."""
         error_message = None
         try:
-            dsn = (
-                db_cstr
-                if db_cstr.startswith("(")
-                else f"{self.db_host}:{self.db_port}/{db_cstr}"
-            )
             start_connect = time.time()
-            self.connection = oracledb.connect(
-                user=self.db_user,
-                password=self.db_pass,
-                dsn=dsn,
-                tcp_connect_timeout=self.db_cursor_timeout_sec,
-            )
+            self.connection = self.open_guarded_connection()
             connection_time = time.time() - start_connect
         except oracledb.DatabaseError as e:
             if "timed out" in str(error_message).lower():
                 error_message = self.format_error_message(db_cstr, e, timeout=True)
             else:
                 error_message = self.format_error_message(db_cstr, e)
+        except breaker.CircuitOpenError as e:
+            error_message = self.FormattedErrorMessage(
+                f"Connection to {self.backend_service_prefix} DB '{db_cstr}' skipped, {e}"
+            )
 
         if error_message:
             self.log.error(error_message)
@@ -119,6 +125,27 @@ class DBStrategy(basedb.BaseDBStrategy):
 
             self.print_backend_connection_time(self.backend, db_cstr, connection_time)
 
+    def open_connection(self):
+        dsn = (
+            self.db_cstr
+            if self.db_cstr.startswith("(")
+            else f"{self.db_host}:{self.db_port}/{self.db_cstr}"
+        )
+        return oracledb.connect(
+            user=self.db_user,
+            password=self.db_pass,
+            dsn=dsn,
+            tcp_connect_timeout=self.db_cursor_timeout_sec,
+        )
+
+    def prepare_query(self, db, cursor, timeout_sec):
+        # call_timeout (ms) lets the driver abort the round trip itself should
+        # connection.cancel() in cancel_query not take effect within the grace period.
+        db.call_timeout = int((timeout_sec + self.cancel_grace_sec) * 1000)
+
+    def cancel_query(self, db):
+        db.cancel()
+
     def _select_connection(self, state_statement_cfg, params):
         """
         Select the appropriate connection object based on the statement configuration.
@@ -166,14 +193,18 @@ class DBStrategy(basedb.BaseDBStrategy):
             # Leave output as it is
             return subresult
         else:
-            sql_output_string = ""
-            for line in subresult:
-                sql_output_string += str(line[0]) + "\n"
-            return sql_output_string
+            return "".join(str(line[0]) + "\n" for line in subresult)
 
     def get_version(self):
         """Get the version of the Oracle DB and return the major and minor version as a string
         Example: 213"""
+        version_info = self.query_version()
+        self.print_version_section(version_info)
+        return version_info["version"]
+
+    def query_version(self):
+        """Query the version of the Oracle DB
+        Example: {"version": "213", "banner": "Oracle Database 21c ..."}"""
 
         version_string = None
         try:
@@ -208,8 +239,6 @@ class DBStrategy(basedb.BaseDBStrategy):
                 # strip major_minor_version to 3 digits
                 major_minor_version_stripped = major_minor_version[:3]
 
-                print(self.cmk_header("oracle_version_v2"))
-                print(f"{self.db_cstr} {ret[0]}")
                 self.log.debug(f"Original Oracle DB version string : {version_string}")
                 self.log.debug(
                     f"Extracted oracle major_minor_version : {major_minor_version}"
@@ -217,7 +246,7 @@ class DBStrategy(basedb.BaseDBStrategy):
                 self.log.debug(
                     f"Stripped oracle major_minor_version : {major_minor_version_stripped}"
                 )
-                return major_minor_version_stripped
+                return {"version": major_minor_version_stripped, "banner": ret[0]}
             else:
                 print("No version string found in Oracle DB return", file=sys.stderr)
                 sys.exit(1)
@@ -227,3 +256,9 @@ class DBStrategy(basedb.BaseDBStrategy):
                 file=sys.stderr,
             )
             sys.exit(1)
+
+    def print_version_section(self, version_info):
+        self.output.write(
+            f"{self.cmk_header('oracle_version_v2')}\n"
+            f"{self.db_cstr} {version_info['banner']}\n"
+        )
@@ -9,7 +9,9 @@ import psycopg2
 import sys
 import time
 import inspect
+import itertools
 from cmk.special_agents.db import basedb
+from cmk.special_agents.db import breaker
 
 _sections_with_db_list = [
     "postgres_bloat",
@@ -28,6 +30,9 @@ _sections_without_column_names = [
 class DBStrategy(basedb.BaseDBStrategy):
     """MySQL DB Strategy Implementation"""
 
+    # The check for an active session needs the complete result, see transform_result
+    unstreamable_statements = ("postgres_sessions",)
+
     def __init__(
         self,
         db_host,
@@ -39,6 +44,8 @@ class DBStrategy(basedb.BaseDBStrategy):
         db_instance,
         db_cursor_timeout_sec,
         loglevel,
+        output=None,
+        probe_time=None,
     ):
         super().__init__(
             db_host,
@@ -50,6 +57,8 @@ class DBStrategy(basedb.BaseDBStrategy):
             db_instance,
             db_cursor_timeout_sec,
             loglevel,
+            output,
+            probe_time,
         )
         # Get the name of the current strategy module
         current_module = inspect.getmodule(inspect.currentframe())
@@ -67,23 +76,23 @@ class DBStrategy(basedb.BaseDBStrategy):
         # TODO: Discuss this more deeply with someone who knows Postgres really well
         self.db_instance = db_instance if db_instance is not None else "main"
 
+        self.db_user = db_user
+        self.db_pass = db_pass
+
         error_message = None
         connection_time = None
         try:
             start_connect = time.time()  # Record start time
-            self.connection = psycopg2.connect(
-                host=db_host,
-                port=db_port,
-                dbname=db_cstr,
-                user=db_user,
-                password=db_pass,
-                connect_timeout=db_cursor_timeout_sec,
-            )
+            self.connection = self.open_guarded_connection()
         except psycopg2.Error as e:
             if "timed out" in str(e).lower():
                 error_message = self.format_error_message(db_cstr, e, timeout=True)
             else:
                 error_message = self.format_error_message(db_cstr, e)
+        except breaker.CircuitOpenError as e:
+            error_message = self.FormattedErrorMessage(
+                f"Connection to {self.backend_service_prefix} DB '{db_cstr}' skipped, {e}"
+            )
 
         if error_message:
             self.log.error(error_message)
@@ -99,6 +108,28 @@ class DBStrategy(basedb.BaseDBStrategy):
             )  # Calculate connection time
             self.print_backend_connection_time(self.backend, db_cstr, connection_time)
 
+    def open_connection(self):
+        return psycopg2.connect(
+            host=self.db_host,
+            port=self.db_port,
+            dbname=self.db_cstr,
+            user=self.db_user,
+            password=self.db_pass,
+            connect_timeout=self.db_cursor_timeout_sec,
+        )
+
+    def prepare_query(self, db, cursor, timeout_sec):
+        # The server cancels the statement itself once timeout_sec is exceeded
+        cursor.execute("SET statement_timeout = %s", (int(timeout_sec * 1000),))
+
+    def cancel_query(self, db):
+        db.cancel()
+
+    def reset_after_error(self, db):
+        # A failed or cancelled statement aborts the current transaction,
+        # which would let all following statements fail as well.
+        db.rollback()
+
     def list_all_dbs(self):
         list_dbs_query = "SELECT datname FROM pg_database WHERE datistemplate = false;"
         self.cursor.execute(list_dbs_query)
@@ -166,7 +197,8 @@ class DBStrategy(basedb.BaseDBStrategy):
                 if len([sr for sr in result if true_in_sr(sr)]) == 0:
                     result.append([(True, 0)])
 
-            for subresult in result[start_line:]:
+            # result is an iterator of row batches if the statement is streamed
+            for subresult in itertools.islice(result, start_line, None):
                 yield self.transform_subresult(statement_name, subresult)
 
     @staticmethod
@@ -183,19 +215,18 @@ class DBStrategy(basedb.BaseDBStrategy):
             # Leave output as it is
             return subresult
         else:
-            sql_output_string = ""
-            for line in subresult:
-                line_strings = [
+            separator = self.separator_char
+            return "".join(
+                separator.join(
                     self.sanitize_output(str(val)) if val is not None else ""
                     for val in line
-                ]
-                sql_output_string += self.separator_char.join(line_strings)
-                sql_output_string += "\n"
-
-            return sql_output_string
+                )
+                + "\n"
+                for line in subresult
+            )
 
     @staticmethod
-    def query(cursor, sqlstatement):
+    def query(cursor, sqlstatement, batch_size=None):
         """
         Run an SQL statement with an open cursor.
         """
@@ -210,5 +241,4 @@ class DBStrategy(basedb.BaseDBStrategy):
             # not returned as part of the query's response, but rather as
             # metadata in the cursor object.
             yield [tuple([desc[0] for desc in cursor.description])]
-            ret = cursor.fetchall()
-            yield ret
+            yield from basedb.fetch_result_set(cursor, batch_size)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+"""
+Optional long running collector daemon for agent_db.
+
+The daemon keeps the database connections of all hosts open, refreshes their
+sections in the background and hands the latest output to the agent_db special
+agent via a Unix domain socket. If the daemon is not running, agent_db queries
+the databases directly.
+
+Start it as site user:
+    python3 -m cmk.special_agents.db.collector
+"""
+
+import argparse
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cmk.special_agents import agent_db
+
+
+def query_collector(socket_path, argv, timeout):
+    """
+    Ask the collector daemon for the latest output of the agent_db call argv.
+
+    Args:
+        socket_path (str): Unix socket of the collector daemon.
+        argv (list): Command line arguments of the agent_db call.
+        timeout (float): Seconds to wait for the answer.
+
+    Returns:
+        dict: {"output": str, "exit_code": int, "error": str} or None if the daemon
+        is not reachable or did not answer in time.
+    """
+    argv = [arg for arg in argv if arg != "--no-collector"]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps({"argv": argv}).encode() + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return json.loads(b"".join(chunks))
+    except (OSError, ValueError):
+        return None
+
+
+class CollectorTarget:
+    """One agent_db call (host) served by the collector"""
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.lock = threading.Lock()
+        self.response = None
+        self.updated = 0.0
+        self.last_request = time.time()
+
+
+class Collector:
+    """Collector daemon: keeps connections warm and refreshes all known hosts"""
+
+    def __init__(self, omd_root, log):
+        self.omd_root = omd_root
+        self.log = log
+        self.targets = {}
+        self.targets_lock = threading.Lock()
+        # Strategies with open connections, keyed by (hostname, backend, cstr)
+        self.strategy_cache = {}
+        self.stop_event = threading.Event()
+        self.config_file = None
+        self.config_mtime = None
+        self.statement_config = None
+
+    @property
+    def settings(self):
+        settings = {
+            "interval_sec": 60,
+            "target_ttl_sec": 600,
+            "workers": 8,
+        }
+        settings.update((self.statement_config or {}).get("collector", {}))
+        return settings
+
+    def _load_statement_config(self):
+        """(Re-)load agent_db.yml if it has been changed"""
+        config_file = agent_db.get_config_file(self.omd_root)
+        config_mtime = os.path.getmtime(config_file)
+        if (config_file, config_mtime) != (self.config_file, self.config_mtime):
+            self.log.log.info(f"Loading config from: {config_file}")
+            self.statement_config = agent_db.load_statement_config(
+                self.omd_root, self.log
+            )
+            self.config_file = config_file
+            self.config_mtime = config_mtime
+        return self.statement_config
+
+    def collect(self, target):
+        """Run agent_db for the target and store its output"""
+        with target.lock:
+            output = io.StringIO()
+            exit_code = 0
+            error = None
+            try:
+                args = agent_db.parse_arguments(target.argv)
+                agent_db.run_agent(
+                    args,
+                    statement_config=self._load_statement_config(),
+                    output=output,
+                    strategy_cache=self.strategy_cache,
+                )
+            except SystemExit as e:
+                # log_error_and_exit, argparse errors, ...
+                exit_code = e.code if isinstance(e.code, int) else 1
+                error = str(e.code)
+            except Exception as e:
+                self.log.log.exception(f"Error while collecting {target.argv}")
+                exit_code = 1
+                error = str(e)
+
+            target.response = {
+                "output": output.getvalue(),
+                "exit_code": exit_code,
+                "error": error,
+            }
+            target.updated = time.time()
+            return target.response
+
+    def get_response(self, argv):
+        """
+        Return the latest output for argv. Unknown hosts and hosts whose output is
+        outdated (e.g. the refresh loop is stuck) are collected right away.
+        """
+        key = tuple(argv)
+        with self.targets_lock:
+            target = self.targets.get(key)
+            if target is None:
+                target = self.targets[key] = CollectorTarget(argv)
+        target.last_request = time.time()
+
+        max_age = 2 * self.settings["interval_sec"]
+        if target.response is None or time.time() - target.updated > max_age:
+            return self.collect(target)
+        return target.response
+
+    def _evict_idle_targets(self):
+        """Forget hosts which have not been asked for and close their connections"""
+        now = time.time()
+        with self.targets_lock:
+            for key, target in list(self.targets.items()):
+                if now - target.last_request > self.settings["target_ttl_sec"]:
+                    self.log.log.info(f"Removing idle target {target.argv}")
+                    del self.targets[key]
+            hostnames = set()
+            for target in self.targets.values():
+                try:
+                    hostnames.add(agent_db.parse_arguments(target.argv).hostname)
+                except SystemExit:
+                    pass
+
+        for key in list(self.strategy_cache):
+            if key[0] not in hostnames:
+                strategy = self.strategy_cache.pop(key, None)
+                if strategy is not None:
+                    try:
+                        strategy.close_db_connection()
+                    except Exception:
+                        pass
+
+    def refresh_loop(self):
+        """Refresh the output of all known hosts once per interval"""
+        while not self.stop_event.is_set():
+            started = time.time()
+            self._evict_idle_targets()
+            with self.targets_lock:
+                due = [
+                    target
+                    for target in self.targets.values()
+                    if started - target.updated >= self.settings["interval_sec"]
+                ]
+            if due:
+                with ThreadPoolExecutor(
+                    max_workers=self.settings["workers"]
+                ) as executor:
+                    list(executor.map(self.collect, due))
+            self.stop_event.wait(
+                max(1.0, self.settings["interval_sec"] - (time.time() - started))
+            )
+
+    def serve(self, socket_path):
+        collector = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                    response = collector.get_response(request["argv"])
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {"output": "", "exit_code": 1, "error": str(e)}
+                self.wfile.write(json.dumps(response).encode())
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        # Only the site user may talk to the collector
+        old_umask = os.umask(0o177)
+        try:
+            server = Server(socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+        self._load_statement_config()
+        refresh_thread = threading.Thread(target=self.refresh_loop, daemon=True)
+        refresh_thread.start()
+        self.log.log.info(f"Collector listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            self.stop_event.set()
+            server.server_close()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            for strategy in self.strategy_cache.values():
+                try:
+                    strategy.close_db_connection()
+                except Exception:
+                    pass
+
+
+def main():
+    omd_root = os.environ["OMD_ROOT"]
+    parser = argparse.ArgumentParser(description="Checkmk DB Special Agent collector")
+    parser.add_argument(
+        "--socket",
+        default=agent_db.get_collector_socket_path(omd_root),
+        help="Unix socket the collector listens on",
+    )
+    parser.add_argument(
+        "--loglevel",
+        default="info",
+        choices=["debug", "info", "warning", "error"],
+        help="Loglevel of the collector log",
+    )
+    args = parser.parse_args()
+
+    logpath = f"{omd_root}/var/log/agent_db"
+    os.makedirs(logpath, exist_ok=True)
+    log = agent_db.AgentDBLog(f"{logpath}/collector.log", args.loglevel)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        Collector(omd_root, log).serve(args.socket)
+    except KeyboardInterrupt:
+        log.log.info("Collector stopped")
+
+
+if __name__ == "__main__":
+    main()
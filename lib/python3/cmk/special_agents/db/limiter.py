@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+import os
+import fcntl
+import random
+import time
+
+
+class SessionSlot:
+    """One acquired session of a SessionLimiter, released by closing its lock file"""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SessionLimiter:
+    """
+    Site-wide limit of the concurrent database sessions of all agent_db processes
+    per database server (db_host, port).
+
+    Every session holds an flock on one of max_sessions slot files of the server.
+    Slots are held as long as the session is open and are released when the
+    process ends, so crashed agents never keep a slot.
+    """
+
+    poll_interval_sec = 0.1
+
+    def __init__(self, lock_dir, db_host, db_port, max_sessions):
+        self.lock_dir = lock_dir
+        self.db_host = db_host
+        self.db_port = db_port
+        self.max_sessions = max_sessions
+
+    def _slot_file(self, index):
+        return os.path.join(self.lock_dir, f"{self.db_host}_{self.db_port}.{index}.lock")
+
+    def _try_acquire(self):
+        # Start at a random slot, so waiting processes don't all compete for slot 0
+        start = random.randrange(self.max_sessions)
+        for offset in range(self.max_sessions):
+            index = (start + offset) % self.max_sessions
+            fd = os.open(self._slot_file(index), os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return SessionSlot(fd)
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def acquire(self, wait_sec=0):
+        """
+        Acquire a session slot, waiting at most wait_sec seconds for a free one.
+
+        Returns:
+            SessionSlot or None if all slots are still in use after wait_sec.
+        """
+        if not os.path.exists(self.lock_dir):
+            os.makedirs(self.lock_dir, exist_ok=True)
+        deadline = time.time() + wait_sec
+        while True:
+            slot = self._try_acquire()
+            if slot is not None or time.time() >= deadline:
+                return slot
+            time.sleep(self.poll_interval_sec)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+import os
+import hashlib
+import json
+import pickle
+import threading
+
+# Statement plans computed in this process, see get_statement_plan
+_plan_cache = {}
+_plan_cache_lock = threading.Lock()
+# The cache is cleared once it has more entries, e.g. after many config changes
+_plan_cache_max_entries = 4096
+
+
+def load_config(configfile, cache_dir):
+    """
+    Load agent_db.yml. The parsed configuration is cached as pickle file in cache_dir,
+    keyed by the path, modification time and size of the config file, so YAML is only
+    parsed again after the config file has been changed.
+
+    Parameters:
+    - configfile (str): Path of the agent_db.yml file.
+    - cache_dir (str): Directory for the compiled configuration.
+
+    Returns:
+    - dict: The configuration.
+    """
+    stat = os.stat(configfile)
+    fingerprint = (configfile, stat.st_mtime_ns, stat.st_size)
+    cache_file = os.path.join(
+        cache_dir,
+        f"config_{hashlib.sha256(configfile.encode()).hexdigest()[:16]}.pkl",
+    )
+
+    try:
+        with open(cache_file, "rb") as f:
+            cached_fingerprint, config = pickle.load(f)
+        if cached_fingerprint == fingerprint:
+            return config
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    import yaml
+
+    with open(configfile, "r") as f:
+        config = yaml.safe_load(f)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first, so concurrent agents never read a partial file
+    tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_file, "wb") as f:
+        pickle.dump((fingerprint, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return config
+
+
+def extract_packages(backend_params):
+    """
+    Extract the packages from the backend parameters.
+
+    Args:
+        backend_params (dict): Backend parameters.
+
+    Returns:
+        list: List of packages extracted from the backend parameters.
+    """
+    packages = []
+    for key in backend_params:
+        # If key ends with "_pkgs" then it should be package list
+        # To ensure that keep that in mind while defining the backend parameters in wato
+        if key.endswith("_pkgs"):
+            packages.extend(backend_params[key])
+    return packages
+
+
+def is_statement_matching(state_statement_cfg, packages):
+    """True if the statement belongs to one of the packages"""
+    for pkg in packages:
+        if pkg in state_statement_cfg["packages"]:
+            return True
+    return False
+
+
+def is_in_execution_scope(state_statement_cfg, db_cstr, db_hostname):
+    """
+    Check the execution_scope of a statement. Every defined criterion
+    (connection_string, db_hostname) has to match.
+    """
+    execution_scope = state_statement_cfg.get("execution_scope")
+    if not execution_scope:
+        return True
+    # Check if the current database connection string is in the execution scope, if defined
+    if "connection_string" in execution_scope:
+        if db_cstr not in execution_scope["connection_string"]:
+            return False
+    # Check if the current database hostname is in the execution scope, if defined
+    if "db_hostname" in execution_scope:
+        if db_hostname not in execution_scope["db_hostname"]:
+            return False
+    return True
+
+
+def build_statement_plan(statement_desc, packages, db_cstr, db_hostname):
+    """
+    Compute the ordered list of statements to execute for one connection.
+
+    Args:
+        statement_desc (dict): statement_desc of the backend from agent_db.yml.
+        packages (list): Statement packages of the host.
+        db_cstr (str): Connection string of the database.
+        db_hostname (str): Checkmk hostname.
+
+    Returns:
+        list: (statement_name, state_statement_cfg) tuples in statement_desc order.
+    """
+    return [
+        (statement_name, state_statement_cfg)
+        for statement_name, state_statement_cfg in statement_desc.items()
+        if is_statement_matching(state_statement_cfg, packages)
+        and is_in_execution_scope(state_statement_cfg, db_cstr, db_hostname)
+    ]
+
+
+def get_statement_plan(statement_desc, backend_params, db_cstr, db_hostname):
+    """
+    Like build_statement_plan, but the plan is computed only once per content of the
+    statement_desc, package set, connection string and hostname, e.g. for all
+    databases of monitor_all. The key does not depend on the statement_desc object,
+    so the descriptions loaded or derived anew by every run of the collector daemon
+    and batch mode hit the same entries.
+    """
+    packages = tuple(extract_packages(backend_params))
+    desc_hash = hashlib.sha256(
+        json.dumps(statement_desc, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    key = (desc_hash, packages, db_cstr, db_hostname)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+    if plan is not None:
+        return plan
+
+    plan = build_statement_plan(statement_desc, packages, db_cstr, db_hostname)
+    with _plan_cache_lock:
+        if len(_plan_cache) >= _plan_cache_max_entries:
+            _plan_cache.clear()
+        _plan_cache[key] = plan
+    return plan
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+import os
+import fcntl
+import hashlib
+import json
+import threading
+
+
+class RuntimeHistory:
+    """
+    Expected runtimes of the statements of one database (db_host, port and connection
+    string), kept across runs in a state file shared by all agent_db processes.
+
+    A runtime above the expected one replaces it right away, lower runtimes lower it
+    gradually, so a statement that got slow is budgeted for its slow runtime at once.
+    """
+
+    # Weight of a new runtime below the expected runtime
+    decay = 0.3
+
+    def __init__(self, state_dir, db_host, db_port, db_cstr):
+        self.state_dir = state_dir
+        # Connection strings may contain characters not allowed in file names
+        cstr_hash = hashlib.sha256(str(db_cstr).encode()).hexdigest()[:16]
+        self.state_file = os.path.join(state_dir, f"{db_host}_{db_port}_{cstr_hash}.json")
+        self._lock = threading.Lock()
+        self._runtimes = None
+        self._recorded = {}
+
+    def _read(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, statement):
+        """Return the expected runtime of the statement in seconds, None if unknown"""
+        with self._lock:
+            if self._runtimes is None:
+                self._runtimes = self._read()
+            return self._runtimes.get(statement)
+
+    def record(self, statement, runtime):
+        """Record the runtime of a statement, written to the state file by save"""
+        with self._lock:
+            self._recorded.setdefault(statement, []).append(runtime)
+
+    def _update(self, runtimes):
+        for statement, recorded in self._recorded.items():
+            for runtime in recorded:
+                expected = runtimes.get(statement)
+                if expected is None or runtime >= expected:
+                    runtimes[statement] = runtime
+                else:
+                    runtimes[statement] = (
+                        expected * (1 - self.decay) + runtime * self.decay
+                    )
+
+    def save(self):
+        """Add the recorded runtimes to the state file"""
+        with self._lock:
+            if not self._recorded:
+                return
+            if not os.path.exists(self.state_dir):
+                os.makedirs(self.state_dir, exist_ok=True)
+            fd = os.open(f"{self.state_file}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # Runtimes recorded by other processes meanwhile are kept
+                runtimes = self._read()
+                self._update(runtimes)
+                tmp_file = f"{self.state_file}.{os.getpid()}.{threading.get_ident()}"
+                with open(tmp_file, "w") as f:
+                    json.dump(runtimes, f)
+                os.replace(tmp_file, self.state_file)
+            finally:
+                # Closing the file releases the lock
+                os.close(fd)
+            self._runtimes = runtimes
+            self._recorded = {}
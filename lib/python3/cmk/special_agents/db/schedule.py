@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+import os
+import fcntl
+import hashlib
+import json
+import threading
+import time
+
+from cmk.special_agents.db import cache
+
+
+def get_interval_in_seconds(state_statement_cfg):
+    """
+    Convert the run interval of a statement from minutes to seconds.
+
+    Args:
+        state_statement_cfg (dict): Configuration of the current statement.
+
+    Returns:
+        int or None: Interval in seconds, or None if the statement runs every time.
+    """
+    interval_min = state_statement_cfg.get("interval_min")
+    return interval_min * 60 if interval_min else None
+
+
+class StatementSchedule:
+    """
+    Last runs of the statements with an interval_min of one database (db_host, port
+    and connection string), kept across runs in a state file shared by all agent_db
+    processes.
+
+    The time is divided into intervals starting at an offset, a statement is due
+    once per interval. Without offset_min the offset is derived from the host,
+    connection string and statement, so the runs of a statement are spread evenly
+    over the interval across hosts instead of all hosts running it at once.
+    """
+
+    def __init__(self, state_dir, db_host, db_port, db_cstr):
+        self.state_dir = state_dir
+        self.schedule_key = f"{db_host}_{db_port}_{db_cstr}"
+        # Connection strings may contain characters not allowed in file names
+        cstr_hash = hashlib.sha256(str(db_cstr).encode()).hexdigest()[:16]
+        self.state_file = os.path.join(state_dir, f"{db_host}_{db_port}_{cstr_hash}.json")
+        self._lock = threading.Lock()
+        self._last_runs = None
+        self._recorded = {}
+
+    def _read(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_offset(self, statement, state_statement_cfg, interval_sec):
+        """Start of the intervals of the statement in seconds after the epoch"""
+        offset_min = state_statement_cfg.get("offset_min")
+        if offset_min is not None:
+            return offset_min * 60
+        return interval_sec * cache.jitter_factor(
+            f"{self.schedule_key}_{statement}", "schedule"
+        )
+
+    def is_due(self, statement, state_statement_cfg, now=None):
+        """
+        Check whether the statement has not run in the current interval yet.
+        Statements without interval_min are always due.
+        """
+        interval_sec = get_interval_in_seconds(state_statement_cfg)
+        if interval_sec is None:
+            return True
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._last_runs is None:
+                self._last_runs = self._read()
+            last_run = self._recorded.get(statement, self._last_runs.get(statement))
+        if last_run is None:
+            return True
+        offset = self.get_offset(statement, state_statement_cfg, interval_sec)
+        return (now - offset) // interval_sec > (last_run - offset) // interval_sec
+
+    def record_run(self, statement, run_time):
+        """Record a successful run of the statement, written to the state file by save"""
+        with self._lock:
+            self._recorded[statement] = max(run_time, self._recorded.get(statement, 0))
+
+    def save(self):
+        """Add the recorded runs to the state file"""
+        with self._lock:
+            if not self._recorded:
+                return
+            if not os.path.exists(self.state_dir):
+                os.makedirs(self.state_dir, exist_ok=True)
+            fd = os.open(f"{self.state_file}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # Runs recorded by other processes meanwhile are kept
+                last_runs = self._read()
+                for statement, run_time in self._recorded.items():
+                    last_runs[statement] = max(run_time, last_runs.get(statement, 0))
+                tmp_file = f"{self.state_file}.{os.getpid()}.{threading.get_ident()}"
+                with open(tmp_file, "w") as f:
+                    json.dump(last_runs, f)
+                os.replace(tmp_file, self.state_file)
+            finally:
+                # Closing the file releases the lock
+                os.close(fd)
+            self._last_runs = last_runs
+            self._recorded = {}
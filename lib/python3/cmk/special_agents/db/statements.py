@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+import os
+import threading
+
+# One repository per sql statement folder, shared by all strategies of the process
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+
+def is_version_string(mystery_string):
+    return mystery_string != "" and all(c in ".0123456789" for c in mystery_string)
+
+
+def comparable_version_from_string(version_string):
+    """
+    Turn a version string into an object we can sort and compare
+
+    This only works for version strings like 1.0.4 or 304
+    but not for c1.23.4r5 or 1.3.0p24
+    """
+    return tuple([int(ver) for ver in version_string.split(".")])
+
+
+def find_suitable_version(sql_version_numbers, db_version):
+    # Find out the closest version number
+    # Example list: version_numbers = [121, 92]
+
+    # If there is a version number in the list of sql_version_numbers which is smaller than the db_version number then use this one.
+    # In case that there are more then one version is smaller than the db_version number then use the highest one.
+    # Example: db_version = 190, sql_version_numbers = [121, 92] --> closest_version = 121
+    # Filter version numbers to those smaller than db_version
+    db_version_number = comparable_version_from_string(db_version)
+    versions_smaller_than_db = [
+        version_number
+        for version_number in sql_version_numbers
+        if version_number <= db_version_number
+    ]
+
+    if versions_smaller_than_db:
+        return max(versions_smaller_than_db)
+    return None
+
+
+class StatementRepository:
+    """
+    In-memory index of the .sql files of one backend's statement folder.
+
+    The folder is indexed once into statement -> {version: filename}. Resolved
+    (statement, db_version) files and the statement texts are kept in memory.
+    The index is invalidated when the modification time of the folder changes,
+    a statement text when the modification time or size of its file changes.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._files = set()
+        self._versions = {}
+        self._resolved = {}
+        self._texts = {}
+
+    def _refresh(self):
+        mtime = os.stat(self.folder).st_mtime_ns
+        if mtime == self._mtime:
+            return
+
+        files = set()
+        versions = {}
+        for filename in os.listdir(self.folder):
+            if not filename.endswith(".sql"):
+                continue
+            files.add(filename)
+            # e.g. oracle_tablespaces_121.sql is version 121 of oracle_tablespaces
+            name = filename[:-4]
+            if "_" in name:
+                statement, version = name.rsplit("_", 1)
+                if is_version_string(version):
+                    versions.setdefault(statement, {})[
+                        comparable_version_from_string(version)
+                    ] = filename
+
+        self._files = files
+        self._versions = versions
+        self._resolved = {}
+        self._texts = {}
+        self._mtime = mtime
+
+    def resolve(self, statement, db_version):
+        """
+        Find the statement file for the database version.
+
+        Example Versions 92, 102, 121, 180, 213. If there is a file with the
+        exact suffix _<version>, it is used, else the file with the closest lower
+        version. If there is no suitable versioned file, the statement file
+        without a version number is used.
+
+        Returns:
+            str: Path of the statement file or None if there is none.
+        """
+        with self._lock:
+            self._refresh()
+            key = (statement, db_version)
+            if key not in self._resolved:
+                self._resolved[key] = self._resolve(statement, db_version)
+            return self._resolved[key]
+
+    def _resolve(self, statement, db_version):
+        statement_versions = self._versions.get(statement, {})
+        closest_version = find_suitable_version(statement_versions, db_version)
+        if closest_version is not None:
+            filename = statement_versions[closest_version]
+        elif f"{statement}.sql" in self._files:
+            # Fallback to the statement without a version number
+            filename = f"{statement}.sql"
+        else:
+            return None
+        return os.path.join(self.folder, filename)
+
+    def read(self, statement, db_version):
+        """
+        Read the statement for the database version.
+
+        Returns:
+            str: The SQL statement without trailing newline and semicolon,
+            or None if there is no statement file.
+        """
+        statement_file = self.resolve(statement, db_version)
+        if statement_file is None:
+            return None
+
+        # Files edited in place do not change the modification time of the folder
+        stat = os.stat(statement_file)
+        file_version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached_version, sql_statement = self._texts.get(
+                statement_file, (None, None)
+            )
+        if sql_statement is None or cached_version != file_version:
+            with open(statement_file, "r") as sqlfile:
+                sql_statement = sqlfile.read()
+            # Remove trailing newline and semicolon from the statement
+            sql_statement = sql_statement.rstrip("\n").rstrip(";")
+            with self._lock:
+                self._texts[statement_file] = (file_version, sql_statement)
+        return sql_statement
+
+
+def get_repository(folder):
+    """Return the StatementRepository of the folder"""
+    with _repositories_lock:
+        repository = _repositories.get(folder)
+        if repository is None:
+            repository = _repositories[folder] = StatementRepository(folder)
+        return repository
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+import json
+import time
+
+
+class AgentOutput:
+    """
+    Buffered writer of the agent output of one run.
+
+    Sections are collected in a buffer, which is written to the stream at the
+    flush points of DBHandler or once it exceeds buffer_bytes. The agent_db_stats
+    entries and the <backend>_connection_time lines of all connections are
+    collected as well and written as one section each by close.
+
+    The buffer of a connection processed in parallel is an AgentOutput writing to a
+    temporary file, see child and merge. Its sections reach the stream once the
+    connections before it are done, on SIGTERM the completed ones are merged.
+    """
+
+    # Completed sections are written at least this often, see flush
+    flush_interval_sec = 1.0
+
+    def __init__(self, stream=None, buffer_bytes=1024 * 1024):
+        self.stream = stream
+        self.buffer_bytes = buffer_bytes
+        self._parts = []
+        self._size = 0
+        self._last_flush = time.time()
+        # {db_cstr: {statement: stats}}
+        self._db_stats = {}
+        # {backend: [connection stats]}
+        self._connection_times = {}
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self.stream is not None and self._size >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self, force=True):
+        """
+        Write the buffered sections to the stream. Called after a section has been
+        completed with force=False, so completed sections are delivered even if the
+        agent is killed later, without a write per section.
+        """
+        if self.stream is None or not self._parts:
+            return
+        if not force and time.time() - self._last_flush < self.flush_interval_sec:
+            return
+        self.stream.write("".join(self._parts))
+        self._parts = []
+        self._size = 0
+        self._last_flush = time.time()
+        if hasattr(self.stream, "flush"):
+            self.stream.flush()
+
+    def add_db_stats(self, db_cstr, statement, stats):
+        """Add the agent_db_stats entry of a statement"""
+        self._db_stats.setdefault(db_cstr, {})[statement] = stats
+
+    def add_skipped_statements(self, db_cstr, statements, reason):
+        """Add agent_db_stats entries for statements which have not been executed"""
+        db_stats = self._db_stats.setdefault(db_cstr, {})
+        for statement in statements:
+            # Statements executed before keep their entry
+            db_stats.setdefault(
+                statement,
+                {"status": "CRIT", "runtime": None, "exception": reason, "timeout": None},
+            )
+
+    def add_connection_time(
+        self, backend, db_cstr, connection_time, error=None, probe_time=None
+    ):
+        """
+        Add the <backend>_connection_time entry of a connection string.
+
+        Args:
+            backend: The backend name, e.g. oracle.
+            db_cstr: The connection string of the database.
+            connection_time: The time taken to establish the connection.
+            error: The error message if the connection failed.
+            probe_time: The time taken by the TCP pre-flight probe of the port (optional).
+        """
+        connection_stats = {
+            "db_cstr": db_cstr,
+            "connection_time": connection_time,
+            "error": str(error) if error else None,
+        }
+        if probe_time is not None:
+            connection_stats["probe_time"] = probe_time
+        self._connection_times.setdefault(backend, []).append(connection_stats)
+
+    def child(self):
+        """
+        Return a buffer for a connection processed in parallel, see merge. Sections
+        beyond buffer_bytes are written to a temporary file instead of memory, e.g.
+        the batches of streamed statements.
+        """
+        import tempfile
+
+        return AgentOutput(
+            tempfile.SpooledTemporaryFile(
+                max_size=self.buffer_bytes, mode="w+", encoding="utf-8"
+            ),
+            self.buffer_bytes,
+        )
+
+    def merge(self, child):
+        """Append the sections and entries of a child buffer and close it"""
+        if child.stream is not None:
+            child.stream.seek(0)
+            while True:
+                chunk = child.stream.read(65536)
+                if not chunk:
+                    break
+                self.write(chunk)
+            child.stream.close()
+        for part in child._parts:
+            self.write(part)
+        for db_cstr, stats in child._db_stats.items():
+            self._db_stats.setdefault(db_cstr, {}).update(stats)
+        for backend, connection_times in child._connection_times.items():
+            self._connection_times.setdefault(backend, []).extend(connection_times)
+
+    def getvalue(self):
+        return "".join(self._parts)
+
+    def write_summary_sections(self):
+        """Write the collected <backend>_connection_time and agent_db_stats sections"""
+        for backend, connection_times in self._connection_times.items():
+            self.write(f"<<<{backend}_connection_time:0>>>\n")
+            self.write("".join(json.dumps(stats) + "\n" for stats in connection_times))
+        if self._db_stats:
+            # One JSON line per connection string, parse_agent_db_stats merges them
+            self.write("<<<agent_db_stats:sep(0)>>>\n")
+            self.write(
+                "".join(
+                    json.dumps({db_cstr: stats}) + "\n"
+                    for db_cstr, stats in self._db_stats.items()
+                )
+            )
+        self._connection_times = {}
+        self._db_stats = {}
+
+    def close(self):
+        """Write the summary sections and flush, the end of the run"""
+        self.write_summary_sections()
+        self.flush()
@@ -56,9 +56,19 @@ def check_agent_db_stats(item, params, section):
 
     db_section = section[item]
     exceptions = []
+    deadline_skipped = []
+    deadline_cached = []
 
     # Check each statement in the database
     for statement, stats in db_section.items():
+        # Statements not run because of the run deadline of the agent or a connection
+        # still busy with a timed out statement, the reason is the exception
+        if stats.get("deadline") == "skipped":
+            deadline_skipped.append(f"{statement}: {stats['exception']}")
+            continue
+        if stats.get("deadline") == "cache":
+            deadline_cached.append(statement)
+
         # Handle exceptions
         if stats["exception"] is not None:
             exceptions.append(f"{statement}: {stats['exception']}")
@@ -77,6 +87,18 @@ def check_agent_db_stats(item, params, section):
                 notice_only=True,
             )
 
+    if deadline_cached:
+        yield Result(
+            state=State.OK,
+            notice=f"Served from cache instead of running: {', '.join(deadline_cached)}",
+        )
+    if deadline_skipped:
+        yield Result(
+            state=State.WARN,
+            summary=f"{len(deadline_skipped)} statements skipped",
+            details="\n".join(deadline_skipped),
+        )
+
     # Overall service state based on exceptions
     if len(exceptions) > 0:
         yield Result(
@@ -15,6 +15,7 @@ from cmk.rulesets.v1.form_specs import(
     Dictionary,
     DictElement,
     FixedValue,
+    Integer,
     List,
     migrate_to_password,
     MultipleChoice,
@@ -23,6 +24,7 @@ from cmk.rulesets.v1.form_specs import(
     SingleChoice,
     SingleChoiceElement,
     String,
+    validators,
 )
 
 # TODO: Fix all multiline strings in this file!
@@ -301,6 +303,34 @@ def parameter_form_enforce_dns_lookup():
         )
 
 
+def parameter_form_parallel_connections():
+    return Integer(
+            title=Title("Parallel connections"),
+            help_text=Help(
+                        "Number of connection strings (e.g. all databases found by 'Monitor all DBs')\
+                         which are processed at the same time. Overrides the setting in agent_db.yml."
+            ),
+            prefill=DefaultValue(1),
+            custom_validate=(validators.NumberInRange(min_value=1),),
+        )
+
+
+def parameter_form_run_deadline_sec():
+    return Integer(
+            title=Title("Run deadline"),
+            help_text=Help(
+                        "Seconds after the start of the special agent by which all statements have to be done.\
+                         Statements are run in the order of their priority and expected runtime.\
+                         Statements whose runtime of the last runs exceeds the time left are served from\
+                         cache or skipped. Should be lower than the timeout of the special agent.\
+                         Overrides the setting in agent_db.yml."
+            ),
+            unit_symbol="s",
+            prefill=DefaultValue(50),
+            custom_validate=(validators.NumberInRange(min_value=1),),
+        )
+
+
 def parameter_form_loglevel():
     return SingleChoice(
             title=Title("Loglevel"),
@@ -339,6 +369,14 @@ def parameter_form():
                                     parameter_form=parameter_form_enforce_dns_lookup(),
                                     required=False,
                                 ),
+            "parallel_connections" : DictElement(
+                                    parameter_form=parameter_form_parallel_connections(),
+                                    required=False,
+                                ),
+            "run_deadline_sec" : DictElement(
+                                    parameter_form=parameter_form_run_deadline_sec(),
+                                    required=False,
+                                ),
             "loglevel" : DictElement(
                             parameter_form=parameter_form_loglevel(),
                             required=True,
@@ -16,6 +16,43 @@ from cmk.server_side_calls.v1 import (
 )
 
 
+def resolve_custom_host_attr(param, value, macros):
+    """
+    Resolve a <<custom_host_attribute>> value from the host macros, like
+    resolve_custom_host_attr of the special agent does via the REST API.
+    Custom host attributes which are added to the monitoring configuration
+    are available as macro $_HOST<ATTRIBUTE>$.
+
+    Returns:
+    str or None: The attribute value or None if it can't be resolved here.
+    """
+    if isinstance(value, list) and param == "db_cstr":
+        value = value[0]
+
+    if isinstance(value, str) and value.startswith("<<") and value.endswith(">>"):
+        custom_host_attr = value.strip("<<>>")
+        return macros.get(f"$_HOST{custom_host_attr.upper()}$")
+
+    return None
+
+
+def resolve_custom_host_attrs(params, macros):
+    """
+    Replace all statically resolvable <<custom_host_attribute>> values. Others
+    are left untouched and resolved by the special agent via the REST API.
+    """
+    for param, value in params.items():
+        resolved_custom_host_attr = resolve_custom_host_attr(param, value, macros)
+        if resolved_custom_host_attr:
+            params[param] = resolved_custom_host_attr
+
+    backend_params = params["db_backend"][1]
+    for key, val in backend_params.items():
+        resolved_custom_host_attr = resolve_custom_host_attr(key, val, macros)
+        if resolved_custom_host_attr:
+            backend_params[key] = resolved_custom_host_attr
+
+
 def generate_agent_db_commands(params, host_config):
     password_arg = params["password"]
 
@@ -28,6 +65,9 @@ def generate_agent_db_commands(params, host_config):
     # Do not include passwords in the b64 argument for security
     params_b64 = {k:v for k,v in params_b64.items() if k != "password"}
 
+    # Resolve custom host attributes now, so the agent doesn't need the REST API
+    resolve_custom_host_attrs(params_b64, host_config.macros)
+
     asm_pw = None
     if params_b64["db_backend"][0] == "cmk_oracle":
         oracle_params = params_b64["db_backend"][1]
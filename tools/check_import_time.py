@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the checkmk "Database Special Agent" agent_db (https://github.com/automation-monitoring/agent_db)
+
+"""
+Check the import time of the agent_db startup path with python -X importtime.
+
+The modules of the startup path are imported in a fresh interpreter several times.
+The check fails if the median of their cumulative import time exceeds the budget
+or if a module which agent_db imports only where it is used is imported at startup.
+The backend module and its DB driver are not part of the check.
+
+Usage:
+    python3 tools/check_import_time.py [--budget-ms 80] [--runs 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules imported by every agent_db run
+STARTUP_MODULES = [
+    "cmk.special_agents.agent_db",
+    "cmk.special_agents.db.basedb",
+]
+
+# Modules imported only by the runs which need them
+LAZY_MODULES = [
+    "requests",
+    "yaml",
+    "pprint",
+    "concurrent.futures",
+    "subprocess",
+    "sqlite3",
+    "selectors",
+    "socket",
+    "tempfile",
+    "queue",
+]
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the agent_db startup path"
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=80,
+        help="Maximum median cumulative import time of the startup modules",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="Number of interpreters the import time is measured in",
+    )
+    parser.add_argument(
+        "--path",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "lib", "python3"
+        ),
+        help="Directory the cmk.special_agents modules are imported from, default: "
+        "lib/python3 of this repository",
+    )
+    return parser.parse_args(argv)
+
+
+def measure_import_time(path):
+    """
+    Import the startup modules in a new interpreter.
+
+    Returns:
+        tuple: Cumulative import time of the startup modules in milliseconds and
+        the names of all imported modules.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [path] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "; ".join(f"import {module}" for module in STARTUP_MODULES),
+        ],
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    total_us = 0
+    imported = set()
+    # import time: self [us] | cumulative | imported package
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not cumulative_us.strip().isdigit():
+            # The header line
+            continue
+        imported.add(name.strip())
+        # The names of nested imports are indented by two more spaces per level
+        if name.strip() in STARTUP_MODULES and not name.startswith("  "):
+            total_us += int(cumulative_us)
+    return total_us / 1000, imported
+
+
+def main(argv=None):
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+
+    # The first run may compile the modules, it is not measured
+    _time_ms, imported = measure_import_time(args.path)
+    times_ms = [measure_import_time(args.path)[0] for _run in range(max(1, args.runs))]
+    median_ms = statistics.median(times_ms)
+
+    failed = False
+    print(
+        f"Import time of {', '.join(STARTUP_MODULES)}: {median_ms:.1f} ms "
+        f"(median of {len(times_ms)} runs, budget {args.budget_ms:.1f} ms)"
+    )
+    if median_ms > args.budget_ms:
+        print("Import time budget exceeded")
+        failed = True
+    for module in LAZY_MODULES:
+        if module in imported:
+            print(f"{module} is imported at startup, import it where it is used")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())